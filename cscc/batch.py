@@ -0,0 +1,159 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Non-interactive batch mode: runs the emissions, cut recommendation and
+# car recommendation steps of cscc.py for every car of a fleet roster.
+# Run from inside this directory with
+# `python3 batch.py roster.csv results.jsonl`.
+
+import re
+import csv
+import sys
+import json
+import math
+import time
+import sqlite3
+import argparse
+import concurrent.futures
+
+import numpy as np
+
+import cscc
+from catalog import VehicleCatalog
+
+
+CHUNK_ROWS = 64 #roster rows sent to a worker process at a time
+WORKER = {} #per process connection, catalog and choices, see init_worker
+
+
+def read_roster(path):
+    """
+    Reads a roster of cars, a .jsonl file of one object per line or a
+    csv file with a header. Each car has a make, model, year and miles
+    (weekly), and optionally a trany, cylinders, drive and rank_order,
+    the names rank_pref returns in order of priority (a list in jsonl,
+    separated by spaces, commas or semicolons in a csv).
+
+    Parameters:
+        path (str): path of the roster
+
+    Returns:
+        generator: one dict per car
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                order = row.get('rank_order') or ''
+                row['rank_order'] = [pref for pref in
+                                     re.split(r'[;,\s]+', order) if pref]
+                yield row
+
+
+def init_worker(db):
+    """
+    Opens the database read only and loads the catalog and choices
+    once per worker process.
+
+    Parameters:
+        db (str): path of cscc.db
+    """
+    WORKER['conn'] = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    WORKER['catalog'] = VehicleCatalog(WORKER['conn'])
+    WORKER['choices'] = cscc.load_choices(WORKER['conn'])
+
+
+def process_car(car):
+    """
+    Runs the recommendation steps of go() for one roster car, in a
+    worker process.
+
+    Parameters:
+        car (dict): roster car
+
+    Returns:
+        dict: the car with its id, emissions, gpm, cut recommendation
+            and recommended cars (or an error) and the seconds it took
+    """
+    start = time.perf_counter()
+    rv = dict(car)
+    try:
+        miles = float(car['miles'])
+        if not 0 <= miles < math.inf:
+            raise ValueError('miles must be a non-negative number')
+        rank_order = list(car.get('rank_order') or [])
+        unknown = set(rank_order) - set(cscc.RANK_PREFS)
+        if unknown:
+            raise ValueError(f'unknown preferences {sorted(unknown)}')
+        id_ = cscc.find_id(WORKER['choices'], car)
+        emissions, gpm = cscc.get_emissions(WORKER['conn'], id_, miles)
+        rv.update(id=id_, emissions=emissions, gpm=gpm,
+                  cut_recommendation=cscc.get_cut_recommendation(emissions,
+                                                                 gpm))
+        cat = WORKER['catalog']
+        rec_df = cat.recommend(id_, miles, rank_order, gpm)
+        if isinstance(rec_df, str):
+            rv['recommendations'] = []
+        else:
+            rec_df = cat.savings(id_, miles, rec_df).iloc[:-1]
+            rv['recommendations'] = rec_df[cscc.REC_COLS].to_dict('records')
+    except Exception as e: # one bad car must not lose the rest of its chunk
+        rv['error'] = f'{type(e).__name__}: {e}'
+    rv['seconds'] = time.perf_counter() - start
+    return rv
+
+
+def run_batch(cars, out, db='cscc.db', workers=None, chunksize=CHUNK_ROWS):
+    """
+    Processes roster cars on a pool of worker processes sharing the
+    database read only, writing one json line per car to out, in
+    roster order, as results come in.
+
+    Parameters:
+        cars (iterable): roster cars, e.g. from read_roster
+        out (file): where to write the results
+        db (str): path of cscc.db
+        workers (int): number of processes, defaults to one per cpu
+        chunksize (int): cars sent to a worker at a time
+
+    Returns:
+        dict: number of cars and errors, total seconds, cars per
+            second and per car latency percentiles in ms
+    """
+    start = time.perf_counter()
+    latencies, errors = [], 0
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(db,)) as executor:
+        for rv in executor.map(process_car, cars, chunksize=chunksize):
+            latencies.append(rv['seconds'])
+            errors += 'error' in rv
+            out.write(json.dumps(rv, default=cscc.to_json) + '\n')
+    took = time.perf_counter() - start
+    ms = np.array(latencies or [0]) * 1000
+    return {'cars': len(latencies), 'errors': errors, 'seconds': took,
+            'cars_per_second': len(latencies) / took,
+            'p50_ms': np.percentile(ms, 50), 'p95_ms': np.percentile(ms, 95),
+            'max_ms': ms.max()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Runs the cscc recommendations for a fleet roster.')
+    parser.add_argument('roster', help='.csv or .jsonl file of cars')
+    parser.add_argument('output', help='.jsonl file to write results to')
+    parser.add_argument('--db', default='cscc.db', help='database to use')
+    parser.add_argument('--workers', type=int, help='processes to use')
+    args = parser.parse_args()
+    with open(args.output, 'w') as out:
+        stats = run_batch(read_roster(args.roster), out, args.db,
+                          args.workers)
+    print(f'{stats["cars"]} cars ({stats["errors"]} errors) in '
+          f'{stats["seconds"]:.1f} s, {stats["cars_per_second"]:.0f} cars/s, '
+          f'latency p50 {stats["p50_ms"]:.1f} ms, p95 {stats["p95_ms"]:.1f} '
+          f'ms, max {stats["max_ms"]:.1f} ms', file=sys.stderr)
@@ -0,0 +1,1255 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Offline benchmarks for the slow parts of cscc.py. Run from inside this
+# directory with `python3 bench.py` to run all of them, or name the ones
+# to run, e.g. `python3 bench.py extract`. The end to end suite runs with
+# `python3 bench.py pipeline --rows 45000,2000000 --save run.json`, and
+# `--compare run.json` on a later run shows what got faster or slower and
+# which stages' results changed.
+
+import os
+import re
+import json
+import hashlib
+import argparse
+import platform
+import pty
+import select
+import signal
+import subprocess
+import itertools
+import concurrent.futures
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import warnings
+import threading
+import http.client
+import http.server
+import urllib.parse
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from prompt_toolkit.document import Document
+from questionary.prompts.autocomplete import WordCompleter
+
+import cscc
+import server
+import catalog
+
+
+MAKES = ['Acura', 'Audi', 'BMW', 'Buick', 'Cadillac', 'Chevrolet', 'Chrysler',
+         'Dodge', 'Fiat', 'Ford', 'GMC', 'Honda', 'Hyundai', 'Infiniti',
+         'Jaguar', 'Jeep', 'Kia', 'Land Rover', 'Lexus', 'Lincoln', 'Mazda',
+         'Mercedes-Benz', 'Mercury', 'Mini', 'Mitsubishi', 'Nissan',
+         'Plymouth', 'Pontiac', 'Porsche', 'Ram', 'Saab', 'Subaru', 'Suzuki',
+         'Tesla', 'Toyota', 'Volkswagen', 'Volvo']
+MODEL_WORDS = ['Accent', 'Altima', 'Aspen', 'Astro', 'Camry', 'Civic',
+               'Colt', 'Corolla', 'Cruze', 'Escape', 'Explorer', 'F150',
+               'Focus', 'Forester', 'Golf', 'Jetta', 'Legacy', 'Malibu',
+               'Maxima', 'Mustang', 'Outback', 'Pathfinder', 'Pilot',
+               'Prius', 'Ranger', 'Sentra', 'Sierra', 'Sonata', 'Tacoma',
+               'Tahoe', 'Taurus', 'Tundra', 'Wrangler', 'Yukon']
+MODEL_SUFFIXES = ['', '', '', ' 2WD', ' 4WD', ' AWD', ' Wagon', ' Hybrid',
+                  ' Sport', ' FFV', ' Pickup 2WD', ' Coupe', ' SE/LE']
+TRANYS = ['Automatic 4-spd', 'Automatic 5-spd', 'Automatic (S6)',
+          'Automatic (AV-S7)', 'Automatic (A1)', 'Manual 5-spd',
+          'Manual 6-spd']
+DRIVES = ['Front-Wheel Drive', 'Rear-Wheel Drive', '4-Wheel Drive',
+          'All-Wheel Drive', '4-Wheel or All-Wheel Drive']
+CLASSES = ['Compact Cars', 'Midsize Cars', 'Large Cars', 'Two Seaters',
+           'Small Station Wagons', 'Small Sport Utility Vehicle 4WD',
+           'Standard Pickup Trucks 2WD', 'Minivan - 2WD',
+           'Sport Utility Vehicle - 4WD']
+
+
+def synthetic_vehicles(n=45000, seed=1):
+    """
+    Generates a vehicles dataset shaped like the fueleconomy.gov csv,
+    restricted to DATA_COLS. Rows are grouped into models spanning
+    several years with a few variants each. Like the real data, about
+    half the rows are missing volume information, a few percent run
+    on two fuels and a few are electric with no tailpipe emissions.
+
+    Parameters:
+        n (int): number of rows
+        seed (int): seed for the generator
+
+    Returns:
+        pd.DataFrame: the dataset, one row per vehicle id
+    """
+    rng = np.random.default_rng(seed)
+    n_models = max(50, n // 12)
+    m_make = rng.integers(len(MAKES), size=n_models)
+    m_name = np.array([MODEL_WORDS[w] + MODEL_SUFFIXES[x] for w, x in
+                       zip(rng.integers(len(MODEL_WORDS), size=n_models),
+                           rng.integers(len(MODEL_SUFFIXES), size=n_models))],
+                      dtype=object)
+    m_start = rng.integers(1984, 2020, size=n_models)
+    m_body = rng.integers(3, size=n_models) # 2 door, 4 door or hatchback
+    m_has_volume = rng.random(n_models) < 0.6
+    m_pv = rng.integers(70, 130, size=n_models)
+    m_lv = rng.integers(8, 25, size=n_models)
+    m_mpg = rng.uniform(12, 45, size=n_models)
+
+    model = rng.integers(n_models, size=n)
+    year = np.minimum(m_start[model] + rng.integers(8, size=n), 2023)
+    pv = np.where(rng.random(n) < 0.9, m_pv[model] + rng.integers(-3, 4, n), 0)
+    lv = np.where(rng.random(n) < 0.9, m_lv[model] + rng.integers(-1, 2, n), 0)
+    pv = np.where(m_has_volume[model], pv, 0)
+    lv = np.where(m_has_volume[model], lv, 0)
+    body = m_body[model]
+
+    kind = rng.random(n)
+    electric, dual = kind < 0.02, (kind >= 0.02) & (kind < 0.07)
+    mpg = m_mpg[model] * rng.uniform(0.9, 1.1, size=n)
+    gpm = np.round(8887 / mpg, 1)
+    cost = np.round(15000 / mpg * 3.2 / 50) * 50
+    fuel_type = np.where(electric, 'Electricity',
+                         np.where(dual, 'Gasoline or E85',
+                                  np.where(rng.random(n) < 0.8,
+                                           'Regular', 'Premium')))
+
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'make': np.array(MAKES, dtype=object)[m_make[model]],
+        'model': m_name[model],
+        'year': year,
+        'trany': np.where(electric, 'Automatic (A1)', np.array(
+            TRANYS, dtype=object)[rng.integers(len(TRANYS), size=n)]),
+        'drive': np.array(DRIVES, dtype=object)[
+            rng.integers(len(DRIVES), size=n)],
+        'cylinders': np.where(electric, np.nan, rng.choice(
+            [3.0, 4.0, 4.0, 5.0, 6.0, 6.0, 8.0, 12.0], size=n)),
+        'VClass': np.array(CLASSES, dtype=object)[
+            rng.integers(len(CLASSES), size=n)],
+        'pv2': np.where(body == 0, pv, 0),
+        'pv4': np.where(body == 1, pv, 0),
+        'hpv': np.where(body == 2, pv, 0),
+        'lv2': np.where(body == 0, lv, 0),
+        'lv4': np.where(body == 1, lv, 0),
+        'hlv': np.where(body == 2, lv, 0),
+        'fuelCost08': np.where(electric, np.round(cost / 3), cost).astype(int),
+        'fuelCostA08': np.where(dual, np.round(cost * 1.3 / 50) * 50,
+                                0).astype(int),
+        'fuelType': fuel_type,
+        'co2TailpipeGpm': np.where(electric, 0.0, gpm),
+        'co2TailpipeAGpm': np.where(dual, np.round(gpm * 0.95, 1), 0.0)})
+
+
+def synthetic_csv(path, n=45000, seed=1):
+    """
+    Writes synthetic_vehicles(n, seed) to a csv that build_db can read.
+
+    Returns:
+        str: path
+    """
+    synthetic_vehicles(n, seed).to_csv(path, index=False)
+    return path
+
+
+def synthetic_db(tmp, n=45000, seed=1):
+    """
+    Builds cscc.db from synthetic_vehicles(n, seed) in the directory
+    tmp, e.g. a TemporaryDirectory.
+
+    Returns:
+        sqlite3.Connection: connection to tmp/cscc.db
+    """
+    conn = sqlite3.connect(os.path.join(tmp, 'cscc.db'))
+    cscc.build_db(conn, synthetic_csv(os.path.join(tmp, 'v.csv'), n, seed))
+    return conn
+
+
+def kbb_page(make, model, year, price=None, kind='car', padding=200):
+    """
+    Builds a page laid out like a kbb model page: a head with a title
+    and several data-rh scripts, a long body, and the script holding
+    the price at the very end.
+
+    Parameters:
+        make (str): make of the car
+        model (str): model slug of the car
+        year (int): year the car was made
+        price (int): price to embed, None to leave it out
+        kind (str): 'car' for a model page, 'missing' for the page kbb
+            serves for unknown slugs, 'error' for its error page
+        padding (int): number of filler blocks in the body, roughly
+            1kB each, to make the page as heavy as a real one
+
+    Returns:
+        bytes: the page
+    """
+    if kind == 'missing':
+        title = 'Find Your Perfect Car | Kelley Blue Book'
+    elif kind == 'error':
+        title = 'Kelley Blue Book | Error'
+    else:
+        title = (f'{year} {make.title()} {model.title()} Price, Value, '
+                 'Ratings &amp; Reviews | Kelley Blue Book')
+    head = (f'<head><meta charset="utf-8"><title>{title}</title>'
+            + ''.join(f'<meta name="m{i}" content="{"x" * 40}">'
+                      for i in range(30))
+            + '<script data-rh="true" type="application/ld+json">'
+              '{"@type":"WebSite","price":"1"}</script></head>')
+    block = ('<div class="css-1"><span>Specs</span><a href="/{0}/">{0}</a>'
+             '<p>{1}</p></div>').format(make.lower(), 'lorem ipsum ' * 70)
+    body = '<body>' + block * padding
+    if price is not None:
+        body += ('<script data-rh="true" type="application/ld+json">'
+                 '{"@type":"Car","offers":{"@type":"Offer","price":"'
+                 f'{price}","priceCurrency":"USD"}}}}</script>')
+    body += '<script>window.__APOLLO__={}</script></body>'
+    return ('<!DOCTYPE html><html lang="en">' + head + body
+            + '</html>').encode()
+
+
+def fixture_corpus(n=60, seed=1, corpus_dir=None):
+    """
+    Returns the pages used to compare price extractors. Saved pages
+    are read from corpus_dir when given, otherwise a seeded mix of
+    model, missing and error pages is generated.
+
+    Parameters:
+        n (int): number of pages to generate
+        seed (int): seed for the generated corpus
+        corpus_dir (str): directory of saved .html pages
+
+    Returns:
+        lst: pages as bytes
+    """
+    if corpus_dir:
+        pages = []
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(corpus_dir, name), 'rb') as f:
+                    pages.append(f.read())
+        return pages
+    rng = random.Random(seed)
+    kinds = ['car'] * 6 + ['missing', 'error']
+    return [kbb_page(rng.choice(['Toyota', 'Honda', 'Ford']),
+                     rng.choice(['camry', 'civic', 'f150', 'model-s']),
+                     rng.randint(1992, 2022),
+                     rng.choice([rng.randint(3000, 90000), None]),
+                     rng.choice(kinds), rng.randint(50, 400))
+            for _ in range(n)]
+
+
+def soup_price_info(html):
+    """
+    Reference extractor: the BeautifulSoup path get_car_prices used
+    before extract_price_info, kept to check results against.
+
+    Parameters:
+        html (bytes): raw page
+
+    Returns:
+        tup: title (str or None), price (str or None)
+    """
+    import bs4
+
+    soup = bs4.BeautifulSoup(html, features="html.parser")
+    titles = soup.find_all("title")
+    title = titles[0].text if titles else None
+    scripts = soup.find_all("script", attrs={"data-rh": "true"})
+    if not scripts:
+        return title, None
+    prices = re.findall('"price":"([0-9]+)"', scripts[-1].text)
+    return title, (prices[0] if prices else None)
+
+
+def timed(func, *args, repeat=1):
+    """
+    Runs func repeat times and returns its last result and the
+    best wall time in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rv = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return rv, best
+
+
+def bench_extract(corpus_dir=None):
+    """
+    Compares extract_price_info with the BeautifulSoup path on the
+    fixture corpus, checking both give the same title and price.
+    """
+    pages = fixture_corpus(corpus_dir=corpus_dir)
+    old, t_old = timed(lambda: [soup_price_info(p) for p in pages])
+    new, t_new = timed(lambda: [cscc.extract_price_info(p) for p in pages],
+                       repeat=5)
+    mismatch = sum(a != b for a, b in zip(old, new))
+    print(f'extract: {len(pages)} pages, '
+          f'{sum(map(len, pages)) / 2 ** 20:.1f} MB, {mismatch} mismatches')
+    print(f'  BeautifulSoup      {t_old * 1000:10.2f} ms')
+    print(f'  extract_price_info {t_new * 1000:10.2f} ms  '
+          f'({t_old / t_new:.0f}x faster)')
+
+
+def legacy_db(connection, source):
+    """
+    Builds the vehicles table the way build_db did before it had a
+    schema: straight from .to_sql, with no primary key or indexes.
+    """
+    df = pd.read_csv(source, usecols=cscc.DATA_COLS, index_col='id')
+    df.to_sql('vehicles', con=connection, if_exists='replace')
+
+
+def lookup_queries(conn, n=300, seed=1):
+    """
+    Picks a sample of cars from the database and returns the lookups
+    get_id, unique_helper (before load_choices), get_emissions and
+    get_fuel_price run for them, as (name, sql, params) tuples.
+    """
+    rows = conn.execute('SELECT id, make, model, year, trany, cylinders '
+                        'FROM vehicles').fetchall()
+    sample = random.Random(seed).sample(rows, min(n, len(rows)))
+    return [
+        ('get_id', f'SELECT id FROM vehicles {cscc.WHERE_CMD}',
+         [row[1:4] for row in sample]),
+        ('unique_helper', f'SELECT drive FROM vehicles {cscc.WHERE_CMD} '
+         'AND trany = ? AND cylinders = ?', [row[1:] for row in sample]),
+        ('get_emissions', 'SELECT co2TailpipeGpm, co2TailpipeAGpm '
+         'FROM vehicles WHERE id = ?', [row[:1] for row in sample]),
+        ('get_fuel_price', 'SELECT fuelCost08, fuelCostA08 FROM vehicles '
+         'WHERE id = ?', [row[:1] for row in sample])]
+
+
+def time_queries(conn, queries):
+    """
+    Returns the mean latency in microseconds of each named query.
+    """
+    rv = {}
+    for name, sql, params in queries:
+        start = time.perf_counter()
+        for param in params:
+            conn.execute(sql, param).fetchall()
+        rv[name] = (time.perf_counter() - start) / len(params) * 1e6
+    return rv
+
+
+def bench_schema(n=45000):
+    """
+    Compares per-query latency of the lookups in cscc.py on an unkeyed
+    table (as older cscc.db files have) against the same table after
+    migrate_db has added the primary key and indexes.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        source = synthetic_csv(os.path.join(tmp, 'vehicles.csv'), n)
+        conn = sqlite3.connect(os.path.join(tmp, 'cscc.db'))
+        legacy_db(conn, source)
+        queries = lookup_queries(conn)
+        before = time_queries(conn, queries)
+        _, t_migrate = timed(cscc.migrate_db, conn)
+        after = time_queries(conn, queries)
+        conn.close()
+    print(f'schema: {n} rows, migrate_db took {t_migrate * 1000:.0f} ms')
+    print(f'  {"query":16}{"unkeyed us":>12}{"keyed us":>12}')
+    for name in before:
+        print(f'  {name:16}{before[name]:12.1f}{after[name]:12.1f}')
+
+
+def co2_emission(co2_1, co2_2, miles):
+    """
+    Reference for the gpm column: the function recommend_cars used to
+    register with sqlite and call for every row of the table.
+    """
+    if co2_2 != 0:
+        co2 = (co2_1 + co2_2)/2
+    else:
+        co2 = co2_1
+    return co2 * miles
+
+
+def bench_candidates(n=45000, trials=20):
+    """
+    Compares the candidate query of recommend_cars on the stored gpm
+    column with the old query calling co2_emission for every row,
+    checking both select the same cars.
+    """
+    udf = ('SELECT id, co2_emission(co2TailpipeGpm, co2TailpipeAGpm, ?) '
+           'AS co2 FROM vehicles WHERE co2 <= ? AND co2 < ?')
+    new = ('SELECT id, gpm * ? FROM vehicles '
+           'WHERE gpm <= ? AND gpm < ? ORDER BY id')
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        conn.create_function('co2_emission', 3, co2_emission)
+        cases = [(rng.uniform(20, 400), rng.uniform(150, 600))
+                 for _ in range(trials)]
+        t_old = t_new = 0
+        mismatch = 0
+        for miles, gpm in cases:
+            old, t = timed(lambda: conn.execute(udf, (
+                miles, cscc.AVG_EMISSION / cscc.WEEKS_IN_YEAR,
+                gpm * miles)).fetchall())
+            t_old += t
+            rows, t = timed(lambda: conn.execute(new, (
+                miles, cscc.AVG_EMISSION / cscc.WEEKS_IN_YEAR / miles,
+                gpm)).fetchall())
+            t_new += t
+            mismatch += [r[0] for r in old] != [r[0] for r in rows]
+        conn.close()
+    print(f'candidates: {n} rows, {trials} queries, {mismatch} mismatches')
+    print(f'  co2_emission udf {t_old / trials * 1000:10.2f} ms/query')
+    print(f'  gpm column       {t_new / trials * 1000:10.2f} ms/query '
+          f'({t_old / t_new:.0f}x faster)')
+
+
+PREFS = ['make', 'year', 'trany', 'VClass', 'fuelType', 'luggage_volume',
+         'passenger_volume']
+
+
+def sessions(conn, trials, seed=1, prefs=PREFS):
+    """
+    Draws random (id, weekly miles, rank order, gpm) sessions for cars
+    above the average emission so recommend_cars has work to do.
+    """
+    rng = random.Random(seed)
+    ids = [row[0] for row in conn.execute(
+               'SELECT id FROM vehicles WHERE gpm > 250 ORDER BY id')]
+    rv = []
+    for _ in range(trials):
+        id_ = rng.choice(ids)
+        miles = rng.choice([50, 150, 300])
+        _, gpm = cscc.get_emissions(conn, id_, miles)
+        rv.append((id_, miles, rng.sample(prefs, rng.randint(0, len(prefs))),
+                   gpm))
+    return rv
+
+
+def same_frame(a, b):
+    """
+    True if two results of recommend_cars hold the same values.
+    """
+    if isinstance(a, str) or isinstance(b, str):
+        return isinstance(a, str) and a == b
+    try:
+        pd.testing.assert_frame_equal(a, b, check_dtype=False,
+                                      check_index_type=False)
+    except AssertionError:
+        return False
+    return True
+
+
+def bench_catalog(n=45000, trials=30):
+    """
+    Compares recommend_cars and get_savings with the VehicleCatalog
+    path on random sessions, checking both return the same frames.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        cat, t_load = timed(catalog.VehicleCatalog, conn)
+        t_sql = t_cat = 0
+        mismatch = 0
+        for id_, miles, order, gpm in sessions(conn, trials):
+            old, t = timed(lambda: cscc.get_savings(conn, id_, miles,
+                cscc.recommend_cars(conn, id_, miles, order, gpm)))
+            t_sql += t
+            new, t = timed(lambda: cat.savings(id_, miles,
+                cat.recommend(id_, miles, order, gpm)))
+            t_cat += t
+            mismatch += not same_frame(old, new)
+        conn.close()
+    print(f'catalog: {n} rows, {trials} sessions, {mismatch} mismatches, '
+          f'load {t_load * 1000:.0f} ms')
+    print(f'  recommend_cars + get_savings {t_sql / trials * 1000:8.2f} ms')
+    print(f'  VehicleCatalog               {t_cat / trials * 1000:8.2f} ms '
+          f'({t_sql / t_cat:.0f}x faster)')
+
+
+def bench_similar(n=45000, trials=200):
+    """
+    Compares the filter cascade of VehicleCatalog.recommend with the
+    ranked nearest neighbour search of VehicleCatalog.similar: time per
+    query, and how far the recommended cars are from the user's car in
+    year and luggage volume on average.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        cat = catalog.VehicleCatalog(conn)
+        runs = sessions(conn, trials)
+        conn.close()
+    paths = {'recommend': cat.recommend, 'nearest': cat.nearest,
+             'similar': cat.similar}
+    print(f'similar: {n} rows, {trials} sessions')
+    print(f'  {"path":12}{"ms/query":>10}{"max ms":>10}'
+          f'{"year diff":>11}{"lv diff %":>11}')
+    for name, path in paths.items():
+        times, years, lvs = [], [], []
+        for id_, miles, order, gpm in runs:
+            rv, t = timed(path, id_, miles, order, gpm)
+            times.append(t)
+            if name == 'nearest':
+                continue
+            car = cat.position(id_)
+            rows = cat.position(rv.id.to_numpy()[:-1])
+            years.append(np.abs(cat.year[rows] - cat.year[car]).mean())
+            lv = cat.filled['lv']
+            if lv[car] > 0:
+                lvs.append(np.abs(lv[rows] / lv[car] - 1).mean() * 100)
+        quality = (f'{np.mean(years):11.2f}{np.mean(lvs):11.1f}' if years
+                   else '')
+        print(f'  {name:12}{np.mean(times) * 1000:10.3f}'
+              f'{max(times) * 1000:10.3f}{quality}')
+    again = [cat.similar(*run).equals(cat.similar(*run)) for run in runs]
+    print(f'  similar is {"" if all(again) else "not "}deterministic')
+
+
+def legacy_prefs(c, id_, df, rank_order):
+    """
+    The rank_order loop of recommend_cars before filter_prefs, on a
+    candidate_cars frame: a new filtered DataFrame per preference.
+    """
+    car = df.iloc[-1]
+    car_lv = max(car.lv2, car.lv4, car.hlv)
+    car_pv = max(car.pv2, car.pv4, car.hpv)
+    for of_interest in rank_order:
+        if of_interest in ["make", "VClass", "fuelType"]:
+            new_df = df[df[of_interest] == car[of_interest]]
+        elif of_interest == "year":
+            new_df = df[(df["year"] >= car["year"] - 5)
+                        & (df["year"] <= car["year"] + 5)]
+        elif of_interest == "trany":
+            m = df["trany"].str.split(" ", expand=True).iloc[:, 0]
+            new_d = pd.concat([df, m], axis=1)
+            new_df = new_d[new_d.iloc[:, -1] == car["trany"].split()[0]]
+            new_df = new_df.drop(new_df.columns[-1], axis=1)
+        elif of_interest == "luggage_volume":
+            if car_lv == 0:
+                car_lv = cscc.get_volume(c, id_, "lv")
+            if car_lv == 0:
+                continue
+            new_df = df[(df["lv"] >= car_lv * 0.95)
+                        & (df["lv"] <= car_lv * 1.05)]
+        else:
+            if car_pv == 0:
+                car_pv = cscc.get_volume(c, id_, "pv")
+            if car_pv == 0:
+                continue
+            new_df = df[(df["pv"] >= car_pv * 0.95)
+                        & (df["pv"] <= car_pv * 1.05)]
+        if len(new_df) <= cscc.MIN_LIMIT:
+            continue
+        df = new_df
+        if len(df) <= cscc.CAR_LIMIT:
+            break
+    return df
+
+
+def bench_prefs(n=45000, trials=1):
+    """
+    Runs the preference stage of recommend_cars for every ordering of
+    the seven preferences on a few sessions, comparing the old loop of
+    DataFrame filters with filter_prefs over masks cached per session.
+    """
+    orders = list(itertools.permutations(PREFS))
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        c = conn.cursor()
+        t_old = t_new = 0
+        mismatch = 0
+        for id_, miles, _, gpm in sessions(conn, trials):
+            df, _ = cscc.candidate_cars(c, id_, miles, gpm)
+            start = time.perf_counter()
+            old = [legacy_prefs(c, id_, df, order).index for order in orders]
+            t_old += time.perf_counter() - start
+            start = time.perf_counter()
+            masks = cscc.pref_masks(c, id_, df)
+            new = [df.index[cscc.filter_prefs(order, masks, len(df))]
+                   for order in orders]
+            t_new += time.perf_counter() - start
+            mismatch += sum(not a.equals(b) for a, b in zip(old, new))
+        conn.close()
+    runs = trials * len(orders)
+    print(f'prefs: {n} rows, {trials} sessions x {len(orders)} rank orders, '
+          f'{mismatch} mismatches')
+    print(f'  DataFrame filters  {t_old / runs * 1000:8.3f} ms/order')
+    print(f'  filter_prefs       {t_new / runs * 1000:8.3f} ms/order '
+          f'({t_old / t_new:.0f}x faster)')
+
+
+def bench_topk(n=45000, trials=200):
+    """
+    Compares keeping CAR_LIMIT cars by the old random sample with
+    keeping the CAR_LIMIT saving the most on fuel over five years:
+    average savings of the cars sent to the price lookups, and the
+    time to pick them out of all the candidates.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        cat = catalog.VehicleCatalog(conn)
+        runs = sessions(conn, trials)
+        conn.close()
+    picks = {'sample': lambda savings: np.random.RandomState(1).choice(
+                 len(savings), cscc.CAR_LIMIT, replace=False),
+             'top_k': lambda savings: cscc.top_k(savings, cscc.CAR_LIMIT)}
+    results = {name: ([], []) for name in picks}
+    for id_, miles, _, gpm in runs:
+        rows = np.flatnonzero(cat.candidates(miles, gpm))
+        if len(rows) <= cscc.CAR_LIMIT:
+            continue
+        own = cat.cost_per_mile[cat.position(id_)]
+        savings = ((own - cat.cost_per_mile[rows]) * miles
+                   * cscc.WEEKS_IN_YEAR * 5)
+        for name, pick in picks.items():
+            chosen, t = timed(pick, savings)
+            results[name][0].append(savings[chosen].mean())
+            results[name][1].append(t)
+    print(f'topk: {n} rows, {len(results["top_k"][0])} sessions with more '
+          f'than {cscc.CAR_LIMIT} candidates')
+    print(f'  {"pick":8}{"5y fuel savings $":>20}{"ms":>8}')
+    for name, (saved, times) in results.items():
+        print(f'  {name:8}{np.mean(saved):20.0f}'
+              f'{np.mean(times) * 1000:8.3f}')
+
+
+def bench_choices(n=200000, trials=200):
+    """
+    Compares answering get_id's questions from the database, as it
+    used to, with the choices saved by index_db: loading the choices,
+    validating a keystroke and listing completions for the make with
+    the most model years.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        choices, t_build = timed(cscc.build_choices, conn)
+        _, t_load = timed(cscc.load_choices, conn)
+        make = max(choices['model_years'],
+                   key=lambda make: len(choices['model_years'][make]))
+        m_ys = choices['model_years'][make]
+        texts = [m_y[:random.Random(i).randint(1, len(m_y))]
+                 for i, m_y in enumerate(random.Random(1).choices(m_ys,
+                                                                 k=trials))]
+        old_check = ('SELECT EXISTS (SELECT 1 FROM vehicles '
+                     'WHERE model || " " || year = ?)')
+        start = time.perf_counter()
+        for text in texts:
+            conn.execute(old_check, (text,)).fetchone()
+        t_old = (time.perf_counter() - start) / trials
+        conn.close()
+    variants = choices['variants'][make]
+    start = time.perf_counter()
+    for text in texts:
+        text in variants
+    t_new = (time.perf_counter() - start) / trials
+    word = WordCompleter(m_ys, ignore_case=True, match_middle=True)
+    prefix = cscc.PrefixCompleter(m_ys)
+    t_word = t_prefix = 0
+    for text in texts:
+        doc = Document(text)
+        t_word += timed(lambda: list(word.get_completions(doc, None)))[1]
+        t_prefix += timed(lambda: list(prefix.get_completions(doc, None)))[1]
+    print(f'choices: {n} rows, {len(m_ys)} model years for {make}, '
+          f'{trials} keystrokes')
+    print(f'  build_choices {t_build * 1000:8.1f} ms, '
+          f'load_choices {t_load * 1000:8.1f} ms')
+    print(f'  validate      {t_old * 1000:8.3f} ms query, '
+          f'{t_new * 1e6:8.3f} us in memory')
+    print(f'  complete      {t_word / trials * 1000:8.3f} ms WordCompleter, '
+          f'{t_prefix / trials * 1000:8.3f} ms PrefixCompleter')
+
+
+class KBBHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers /make/model/year/ like kbb, with kbb_page pages: a model
+    page for one word model slugs, the missing car page otherwise.
+    Other paths get a 404. The server's delay, error_rate and rng make
+    it slow or failing, and with redirect set paths with capitals are
+    redirected to their lowercase form.
+    """
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.hits += 1
+            srv.paths.append(self.path)
+            fail = srv.rng.random() < srv.error_rate
+        time.sleep(srv.delay)
+        if fail:
+            self.send_error(503)
+            return
+        if srv.redirect and self.path != self.path.lower():
+            self.send_response(301)
+            self.send_header('Location', self.path.lower())
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3:
+            self.send_error(404)
+            return
+        make, model, year = parts
+        if '-' in model:
+            page = kbb_page(make, model, year, kind='missing', padding=20)
+        else:
+            price = 5000 + sum(self.path.encode()) * 7 % 60000
+            page = kbb_page(make, model, year, price, padding=20)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def kbb_server(delay=0.0, error_rate=0.0, seed=1, redirect=False):
+    """
+    Starts a stand-in for kbb on a free local port, in the background.
+
+    Returns:
+        tup: the server (shutdown() it when done) and the price page
+            url format string to use in place of KBB_URL
+    """
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KBBHandler)
+    srv.daemon_threads = True
+    srv.handle_error = lambda request, address: None # clients timing out
+    srv.delay, srv.error_rate, srv.redirect = delay, error_rate, redirect
+    srv.rng, srv.lock, srv.hits = random.Random(seed), threading.Lock(), 0
+    srv.paths = [] # in the order they were asked for
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f'http://127.0.0.1:{srv.server_port}/{{}}/{{}}/{{}}/'
+
+
+def price_cars(n=20, seed=1):
+    """
+    Returns n (make, possible models, year) lookups as get_car_prices
+    would make them for recommended cars.
+    """
+    rng = random.Random(seed)
+    rows = [pd.Series({'make': rng.choice(MAKES),
+                       'model': (f'{rng.choice(MODEL_WORDS)} '
+                                 f'{rng.choice(MODEL_SUFFIXES)}').strip(),
+                       'year': rng.randint(1992, 2022)}) for _ in range(n)]
+    return [cscc.get_info_for_price(row) for row in rows]
+
+
+def bench_crawler(n=20):
+    """
+    Crawls the prices of n cars from kbb stand-ins that are healthy,
+    failing a third of the time, slower than the read timeout and
+    down, with short timeouts and budgets, and reports how long each
+    took, how many prices were found and what the Crawler counted.
+    """
+    scenarios = {'healthy': {'delay': 0.05}, 'flaky': {'error_rate': 0.3},
+                 'slow': {'delay': 1.0}, 'down': {}}
+    cars = price_cars(n)
+    print(f'crawler: {n} cars, 0.3 s timeouts, 2 retries, '
+          '1.5 s budget per car')
+    keys = list(cscc.Crawler().stats)
+    print(f'  {"server":9}{"s":>6}{"found":>7}{"failed":>8}'
+          + ''.join(f'{key:>14}' for key in keys))
+    for name, options in scenarios.items():
+        srv, url = kbb_server(**options)
+        if name == 'down':
+            srv.shutdown()
+            srv.server_close()
+        crawler = cscc.Crawler(timeout=(0.3, 0.3), retries=2, backoff=0.05,
+                               budget=1.5, failures=10, cooldown=30)
+        start = time.perf_counter()
+        found = failed = 0
+        with concurrent.futures.ThreadPoolExecutor(cscc.PRICE_WORKERS) as ex:
+            futures = [ex.submit(cscc.fetch_price, crawler, url, *car)
+                       for car in cars]
+            for future in futures:
+                try:
+                    found += future.result()[0] is not None
+                except cscc.CrawlError:
+                    failed += 1
+        took = time.perf_counter() - start
+        if name != 'down':
+            srv.shutdown()
+        print(f'  {name:9}{took:6.2f}{found:7}{failed:8}'
+              + ''.join(f'{crawler.stats[key]:14}' for key in keys))
+
+
+def service_requests(conn, n, seed=1):
+    """
+    Draws n requests to the Service like a tool running sessions would
+    make them: an id lookup, emissions, the cut recommendation and the
+    recommendations (a fifth of them similar).
+    """
+    rng = random.Random(seed)
+    cars = conn.execute('SELECT id, make, model, year FROM vehicles '
+                        'WHERE gpm > 0').fetchall()
+    rv = []
+    for id_, make, model, year in rng.sample(cars, n // 4 + 1):
+        miles = rng.choice([50, 150, 300])
+        order = ','.join(rng.sample(PREFS, rng.randint(0, 3)))
+        similar = '&similar=1' if rng.random() < 0.2 else ''
+        rv += ['/id?' + urllib.parse.urlencode({'make': make, 'model': model,
+                                                'year': year}),
+               f'/emissions?id={id_}&miles={miles}',
+               f'/cut?id={id_}&miles={miles}',
+               f'/recommend?id={id_}&miles={miles}&rank_order={order}'
+               + similar]
+    return rv[:n]
+
+
+def load_test(port, paths, clients):
+    """
+    Sends the paths to the service on port from clients threads, each
+    keeping its connection alive, and returns the wall time, latencies
+    in seconds and the number of non 200 responses.
+    """
+    todo = iter(paths)
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+
+    def client():
+        http_conn = http.client.HTTPConnection('127.0.0.1', port)
+        while True:
+            with lock:
+                path = next(todo, None)
+            if path is None:
+                break
+            start = time.perf_counter()
+            http_conn.request('GET', path)
+            response = http_conn.getresponse()
+            response.read()
+            took = time.perf_counter() - start
+            with lock:
+                latencies.append(took)
+                errors[0] += response.status != 200
+        http_conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def bench_service(n=45000, requests=2000, clients=(1, 8, 32)):
+    """
+    Starts the Service on a synthetic database and reports its
+    throughput and latency under growing numbers of concurrent
+    clients, with one pooled connection and with POOL_SIZE of them.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        db = os.path.join(tmp, 'cscc.db')
+        paths = service_requests(conn, requests)
+        conn.close()
+        print(f'service: {n} rows, {requests} requests per run')
+        print(f'  {"pool":>4}{"clients":>8}{"req/s":>8}{"p50 ms":>8}'
+              f'{"p99 ms":>8}{"errors":>7}')
+        for pool_size in (1, server.POOL_SIZE):
+            srv = server.Service(db, 0, pool_size)
+            threading.Thread(target=srv.serve_forever, daemon=True).start()
+            for count in clients:
+                took, latencies, errors = load_test(srv.server_port, paths,
+                                                    count)
+                ms = np.array(latencies) * 1000
+                print(f'  {pool_size:4}{count:8}{len(ms) / took:8.0f}'
+                      f'{np.percentile(ms, 50):8.1f}'
+                      f'{np.percentile(ms, 99):8.1f}{errors:7}')
+            srv.shutdown()
+            srv.server_close()
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'urllib3', 'certifi'] #loaded on first use
+EAGER = 'import ' + ', '.join(HEAVY_MODULES) + '; ' #as cscc.py used to
+
+
+def import_ms(code):
+    """
+    Runs code in a fresh interpreter with -X importtime and returns
+    the milliseconds spent importing cscc and what it imported.
+    """
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stderr
+    rv = 0
+    for line in err.splitlines():
+        _, _, cumulative, name = line.replace(':', '|', 1).split('|')
+        if name[2:3] != ' ' and name.strip() in HEAVY_MODULES + ['cscc']:
+            rv += int(cumulative) # only counting top level imports
+    return rv / 1000
+
+
+def first_prompt(code, cwd, text=b"car's make", timeout=60):
+    """
+    Runs code in a fresh interpreter on a pseudo terminal from cwd and
+    returns the seconds until text, the first question, is shown.
+    """
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.chdir(cwd)
+        os.execv(sys.executable, [sys.executable, '-c', code])
+    out = b''
+    try:
+        while text not in out:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(out[-200:])
+            if select.select([fd], [], [], 0.5)[0]:
+                out += os.read(fd, 4096)
+        return time.perf_counter() - start
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+def bench_startup(n=45000, trials=5):
+    """
+    Reports the median import time of cscc and time until the first
+    question of a session is shown, importing the heavy modules up
+    front as cscc.py used to and on first use, and checks importing
+    cscc doesn't load any of them.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    run = ('import runpy, sys; sys.path.insert(0, {!r}); '
+           'runpy.run_path({!r}, run_name="__main__")'
+           .format(here, os.path.join(here, 'cscc.py')))
+    loaded = subprocess.run(
+        [sys.executable, '-c', 'import sys; before = set(sys.modules); '
+         'import cscc; print(" ".join(m for m in '
+         f'{HEAVY_MODULES!r} if m in set(sys.modules) - before))'], cwd=here,
+        capture_output=True, text=True, check=True).stdout.split()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        conn.close()
+        print(f'startup: median of {trials}, {n} rows')
+        print(f'  {"":8}{"import ms":>10}{"first prompt ms":>16}')
+        for name, prefix in (('eager', EAGER), ('lazy', '')):
+            imports = [import_ms(prefix + 'import cscc')
+                       for _ in range(trials)]
+            prompts = [first_prompt(prefix + run, tmp)
+                       for _ in range(trials)]
+            print(f'  {name:8}{np.median(imports):10.0f}'
+                  f'{np.median(prompts) * 1000:16.0f}')
+    print('  loaded by import cscc: ' + (' '.join(loaded) or 'none'))
+
+
+def digest(*values):
+    """
+    Short hash of the results of a stage, so runs can be compared
+    without keeping the results themselves.
+    """
+    h = hashlib.sha1()
+    for value in values:
+        if isinstance(value, pd.DataFrame):
+            value = value.round(6).to_csv(index=False)
+        h.update(repr(value).encode())
+    return h.hexdigest()[:12]
+
+
+def pipeline_run(n, trials=3, lookups=1000, orders=None, seed=1):
+    """
+    Times every stage of a session, end to end, on an n row synthetic
+    database with a kbb stand-in answering the price lookups.
+
+    Parameters:
+        n (int): rows of the database
+        trials (int): sessions run, stages are timed on each
+        lookups (int): get_id lookups timed
+        orders (int): rank orders run through recommend_cars per
+            session, every ordering of the preferences by default
+        seed (int): seed for the data and the sessions
+
+    Returns:
+        dict: stage -> {'ms': median ms per call, 'digest': digest of
+            its results}
+    """
+    all_orders = list(itertools.permutations(PREFS))
+    all_orders = all_orders[:orders] if orders else all_orders
+    times, results = {}, {}
+
+    def record(stage, func, *args):
+        rv, t = timed(func, *args)
+        times.setdefault(stage, []).append(t * 1000)
+        results.setdefault(stage, []).append(rv)
+        return rv
+
+    srv, url = kbb_server(delay=0.01)
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = synthetic_csv(os.path.join(tmp, 'v.csv'), n, seed)
+        conn = sqlite3.connect(os.path.join(tmp, 'cscc.db'))
+        record('build_db', cscc.build_db, conn, csv_path)
+        results['build_db'] = [conn.execute(
+            'SELECT count(*), total(gpm), total(pv), total(lv), '
+            'count(DISTINCT family) FROM vehicles').fetchone()]
+        choices = record('load_choices', cscc.load_choices, conn)
+        rng = random.Random(seed)
+        cars = [dict(zip(['make', 'model', 'year'], row)) for row in
+                rng.sample(conn.execute('SELECT make, model, year '
+                                        'FROM vehicles').fetchall(),
+                           min(lookups, n))]
+        ids = record('get_id', lambda: [cscc.find_id(choices, car)
+                                        for car in cars])
+        times['get_id'] = [times['get_id'][0] / len(cars)]
+        results['get_id'] = [digest(ids)]
+        for id_, miles, _, gpm in sessions(conn, trials, seed):
+            cands = record('candidate_cars', cscc.candidate_cars,
+                           conn.cursor(), id_, miles, gpm)
+            recs = [record('recommend_cars', cscc.recommend_cars, conn, id_,
+                           miles, list(order), gpm,
+                           (cands[0], dict(cands[1])))
+                    for order in all_orders]
+            df = record('get_savings', cscc.get_savings, conn, id_, miles,
+                        recs[0])
+            priced, old = record('get_car_prices', cscc.get_car_prices, df,
+                                 None, url, 0, None, None, None,
+                                 cscc.Crawler(timeout=(1, 1), budget=5))
+            record('calculate_savings', cscc.calculate_savings, priced, old)
+        conn.close()
+    srv.shutdown()
+    return {stage: {'ms': float(np.median(ms)),
+                    'digest': digest(*results[stage])}
+            for stage, ms in times.items()}
+
+
+def bench_pipeline(rows=(45000,), save=None, compare=None, **kwargs):
+    """
+    Runs pipeline_run at every scale in rows and prints how long each
+    stage took. The timings and result digests are saved to save as
+    JSON, if given, and compared with those of an earlier run saved to
+    compare, flagging stages whose results changed.
+    """
+    run = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'machine': platform.machine(), 'rows': {}}
+    old = {}
+    if compare:
+        with open(compare) as f:
+            old = json.load(f)['rows']
+    for n in rows:
+        print(f'pipeline: {n} rows')
+        print(f'  {"stage":18}{"ms":>12}' + (f'{"before":>12}{"ratio":>8}'
+                                             '  results' if compare else ''))
+        stages = run['rows'][str(n)] = pipeline_run(n, **kwargs)
+        for stage, st in stages.items():
+            line = f'  {stage:18}{st["ms"]:12.3f}'
+            before = old.get(str(n), {}).get(stage)
+            if before:
+                line += (f'{before["ms"]:12.3f}{st["ms"] / before["ms"]:8.2f}'
+                         + ('  same' if before['digest'] == st['digest']
+                            else '  CHANGED'))
+            print(line)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(run, f, indent=1)
+    return run
+
+
+def table_volume(c, id_, type_):
+    """
+    Reference for get_volume: how it used to find one car's volume,
+    by loading the whole vehicles table into a DataFrame.
+    """
+    b = c.execute('SELECT id, make, model, pv2, pv4, hpv, lv2, lv4, hlv, '
+                  'fuelType, VClass, year, trany, pv, lv FROM vehicles')
+    new_df = pd.DataFrame(b.fetchall(),
+                          columns=['id', 'make', 'model', 'pv2', 'pv4', 'hpv',
+                                   'lv2', 'lv4', 'hlv', 'fuelType', 'VClass',
+                                   'year', 'trany', 'pv', 'lv'])
+    return new_df[new_df['id'] == id_][type_].item()
+
+
+def peak(func, *args):
+    """
+    Runs func and returns its result, wall time in seconds and peak
+    traced memory in bytes.
+    """
+    tracemalloc.start()
+    rv, t = timed(func, *args)
+    mem = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rv, t, mem
+
+
+def bench_volume(n=45000, trials=20):
+    """
+    Compares ways of finding the volume of cars missing it: loading
+    the whole table (the old get_volume), get_volume reading the value
+    filled in by build_db, and sibling_volume computing it from the
+    neighbouring rows only.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        c = conn.cursor()
+        cars = random.Random(1).sample(c.execute(
+            'SELECT id, make, model, year FROM vehicles '
+            'WHERE max(lv2, lv4, hlv) = 0').fetchall(), trials)
+        paths = {'whole table': lambda car: table_volume(c, car[0], 'lv'),
+                 'get_volume': lambda car: cscc.get_volume(c, car[0], 'lv'),
+                 'sibling_volume': lambda car: cscc.sibling_volume(
+                     c, *car, 'lv')}
+        results = {}
+        print(f'volume: {n} rows, {trials} cars missing luggage volume')
+        print(f'  {"path":16}{"ms/car":>10}{"peak kB":>12}')
+        for name, path in paths.items():
+            runs = [peak(path, car) for car in cars]
+            results[name] = [rv for rv, _, _ in runs]
+            t_avg = sum(t for _, t, _ in runs) / trials
+            mem = max(mem for _, _, mem in runs)
+            print(f'  {name:16}{t_avg * 1000:10.3f}{mem / 1024:12.1f}')
+        conn.close()
+    mismatch = sum(not np.allclose(results['whole table'], vals)
+                   for vals in results.values())
+    print(f'  {mismatch} paths disagree with the whole table lookup')
+
+
+def row_savings(conn, id_, use_miles, df):
+    """
+    get_savings before fuel costs were batched: one get_fuel_price
+    query per row.
+    """
+    def fuel_price(car):
+        fuel1, fuel2 = conn.execute(
+            'SELECT fuelCost08, fuelCostA08 FROM vehicles WHERE id = ?',
+            (car,)).fetchone()
+        cost = (fuel1 + fuel2) / 2 if fuel2 else fuel1
+        return (cost / cscc.YEARLY_MILES) * use_miles
+
+    old_weekly_cost = fuel_price(id_)
+    df.loc[:, "weekly_cost"] = df.loc[:, "id"].apply(fuel_price)
+    df.loc[:, "yearly_cost"] = df.loc[:, "weekly_cost"] * cscc.WEEKS_IN_YEAR
+    df.loc[:, "weekly_savings"] = old_weekly_cost - df.loc[:, "weekly_cost"]
+    df.loc[:, "yearly_savings"] = (old_weekly_cost * cscc.WEEKS_IN_YEAR
+                                   - df.loc[:, "yearly_cost"])
+    return df
+
+
+def bench_savings(n=45000, sizes=(21, 500, 5000, 20000)):
+    """
+    Compares get_savings looking fuel costs up one row at a time with
+    the batched lookup, over candidate sets of growing size.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = synthetic_db(tmp, n)
+        ids = [id_ for id_, in conn.execute('SELECT id FROM vehicles')]
+        rng = random.Random(1)
+        print(f'savings: {n} rows')
+        print(f'  {"cars":>8}{"per row ms":>14}{"batched ms":>14}{"same":>6}')
+        for size in sizes:
+            df = pd.DataFrame({'id': rng.sample(ids, size)})
+            old, t_old = timed(row_savings, conn, ids[0], 60, df.copy())
+            new, t_new = timed(cscc.get_savings, conn, ids[0], 60, df.copy())
+            print(f'  {size:8}{t_old * 1000:14.1f}{t_new * 1000:14.1f}'
+                  f'{str(same_frame(old, new)):>6}')
+        conn.close()
+
+
+DTYPE_FILTERS = ['make', 'VClass', 'fuelType', 'trany_family', 'year', 'pv']
+
+
+def dtype_masks(df, car):
+    """
+    The filters pref_masks runs on a candidate_cars frame, for the
+    DTYPE_FILTERS of one car.
+    """
+    masks = {col: (df[col] == car[col]).to_numpy()
+             for col in DTYPE_FILTERS[:4]}
+    masks['year'] = ((df['year'] >= car['year'] - 5)
+                     & (df['year'] <= car['year'] + 5)).to_numpy()
+    v = df['pv'].to_numpy()
+    masks['pv'] = (v >= car['pv'] * 0.95) & (v <= car['pv'] * 1.05)
+    return masks
+
+
+def bench_dtypes(n=2000000, trials=5, chunk=200000):
+    """
+    Compares vehicle frames as pandas infers them from the database's
+    rows with the categoricals and small dtypes of vehicle_frame, on
+    the memory they take and the time of pref_masks' filters, checking
+    both filters keep the same rows.
+    """
+    df = synthetic_vehicles(n)
+    df['trany_family'] = df['trany'].str.split().str[0]
+    df['pv'] = df[['pv2', 'pv4', 'hpv']].max(axis=1).astype(float)
+    df['lv'] = df[['lv2', 'lv4', 'hlv']].max(axis=1).astype(float)
+    df['gpm'] = df['co2TailpipeGpm']
+    cols = ['id', 'make', 'model', 'pv2', 'pv4', 'hpv', 'lv2', 'lv4', 'hlv',
+            'fuelType', 'VClass', 'gpm', 'year', 'trany', 'pv', 'lv',
+            'trany_family']
+    categories = {col: pd.CategoricalDtype(sorted(df[col].unique()))
+                  for col in cscc.CATEGORY_COLS if col in cols}
+    t_old = t_new = 0
+    old, new = [], []
+    for start in range(0, n, chunk): # rows as fetchall() would give them
+        rows = list(df[cols].iloc[start:start + chunk].itertuples(
+            index=False, name=None))
+        frame, t = timed(pd.DataFrame, rows, None, cols)
+        old.append(frame)
+        t_old += t
+        frame, t = timed(cscc.vehicle_frame, rows, cols, categories)
+        new.append(frame)
+        t_new += t
+    del df, rows
+    old = pd.concat(old, ignore_index=True)
+    new = pd.concat(new, ignore_index=True)
+    mem_old = old.memory_usage(deep=True).sum()
+    mem_new = new.memory_usage(deep=True).sum()
+
+    rng = random.Random(1)
+    f_old = f_new = 0
+    mismatch = 0
+    for _ in range(trials):
+        car = old.iloc[rng.randrange(n)]
+        a, t = timed(dtype_masks, old, car)
+        f_old += t
+        b, t = timed(dtype_masks, new, car)
+        f_new += t
+        mismatch += sum(not np.array_equal(a[col], b[col])
+                        for col in DTYPE_FILTERS)
+    print(f'dtypes: {n} rows, {trials} cars x {len(DTYPE_FILTERS)} filters, '
+          f'{mismatch} mismatches')
+    print(f'  {"":16}{"MiB":>10}{"load ms":>10}{"filters ms":>12}')
+    print(f'  {"inferred":16}{mem_old / 2**20:10.1f}{t_old * 1000:10.0f}'
+          f'{f_old / trials * 1000:12.1f}')
+    print(f'  {"vehicle_frame":16}{mem_new / 2**20:10.1f}{t_new * 1000:10.0f}'
+          f'{f_new / trials * 1000:12.1f}')
+    print(f'  {mem_old / mem_new:.1f}x less memory, filters '
+          f'{f_old / f_new:.1f}x faster')
+
+
+BENCHMARKS = {'extract': bench_extract, 'schema': bench_schema,
+              'candidates': bench_candidates, 'catalog': bench_catalog,
+              'volume': bench_volume, 'savings': bench_savings,
+              'similar': bench_similar, 'prefs': bench_prefs,
+              'topk': bench_topk, 'choices': bench_choices,
+              'crawler': bench_crawler, 'service': bench_service,
+              'startup': bench_startup, 'dtypes': bench_dtypes,
+              'pipeline': bench_pipeline}
+
+
+if __name__ == "__main__":
+    warnings.simplefilter('ignore', FutureWarning) # pandas DataFrame.append
+    parser = argparse.ArgumentParser(description='Offline cscc benchmarks.')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all but pipeline by default')
+    parser.add_argument('--rows', default='45000',
+                        help='pipeline: comma separated database sizes, '
+                             'e.g. 45000,1000000,2000000')
+    parser.add_argument('--orders', type=int,
+                        help='pipeline: rank orders per session, all 5040 '
+                             'by default')
+    parser.add_argument('--save', help='pipeline: file to save results to')
+    parser.add_argument('--compare',
+                        help='pipeline: saved results to compare with')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {sorted(unknown)}, choose from '
+                     f'{list(BENCHMARKS)}')
+    for name in args.names or [name for name in BENCHMARKS
+                               if name != 'pipeline']:
+        if name == 'pipeline':
+            bench_pipeline([int(n) for n in args.rows.split(',')], args.save,
+                           args.compare, orders=args.orders)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,333 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# In-memory copy of the vehicles table for the recommendation path.
+
+import numpy as np
+import pandas as pd
+
+import cscc
+
+
+class VehicleCatalog:
+    """
+    Holds the columns of the vehicles table needed for recommendations
+    as NumPy arrays, loaded once, so that recommending cars, resolving
+    missing volumes and computing savings are vectorized masks over
+    the arrays instead of new queries and DataFrames on every call.
+    Rows are kept in id order, the order recommend_cars reads them in.
+
+    Categorical columns are stored as integer codes into an array of
+    their distinct values, so equality filters compare integers.
+    """
+    CATEGORICAL = ['make', 'VClass', 'fuelType', 'trany']
+    FRAME_COLS = ['id', 'make', 'model', 'pv2', 'pv4', 'hpv', 'lv2', 'lv4',
+                  'hlv', 'fuelType', 'VClass', 'co2_emission', 'year', 'trany',
+                  'pv', 'lv']
+    FEATURES = {'year': 0, 'passenger_volume': 1, 'luggage_volume': 2}
+    GPM_WEIGHT = 0.5 # below the weight of the lowest ranked preference
+    MISSING = 4.0 # distance, in standard deviations, of an unknown volume
+
+    def __init__(self, conn):
+        """
+        Loads the catalog from the vehicles table.
+
+        Parameters:
+            conn (obj): connection to sqlite database we will be querying
+        """
+        cols = ['id', 'make', 'model', 'year', 'trany', 'VClass', 'fuelType',
+                'pv2', 'pv4', 'hpv', 'lv2', 'lv4', 'hlv', 'fuelCost08',
+                'fuelCostA08', 'gpm', 'pv', 'lv', 'trany_family']
+        c = conn.cursor()
+        rows = c.execute(f'SELECT {", ".join(cols)} FROM vehicles '
+                         'ORDER BY id').fetchall()
+        c.close()
+        # emissions at full precision, as the thresholds recommend_cars
+        # compares them to are computed by sqlite
+        df = cscc.vehicle_frame(rows, cols, cscc.load_categories(conn),
+                                {'gpm': 'float64'})
+        del rows
+
+        self.ids = df['id'].to_numpy()
+        self.year = df['year'].to_numpy()
+        self.model = df['model'].to_numpy()
+        self.gpm = df['gpm'].to_numpy(dtype=float)
+        self.volumes = {col: df[col].to_numpy() for col in cols[7:13]}
+        self.filled = {type_: df[type_].to_numpy(dtype=float)
+                       for type_ in cscc.VOLUME_COLS}
+
+        fuel1 = df['fuelCost08'].to_numpy(dtype=float)
+        fuel2 = np.nan_to_num(df['fuelCostA08'].to_numpy(dtype=float))
+        cost = np.where(fuel2 != 0, (fuel1 + fuel2) / 2, fuel1)
+        self.cost_per_mile = cost / cscc.YEARLY_MILES
+
+        self.codes, self.categories = {}, {}
+        for col in self.CATEGORICAL:
+            self.codes[col] = df[col].cat.codes.to_numpy()
+            self.categories[col] = df[col].cat.categories
+        self.trany_first = df['trany_family'].cat.codes.to_numpy()
+
+        # year, pv, lv and gpm scaled to unit standard deviation, with
+        # unknown (0) volumes as nan; gpm is measured from 0 g/mi
+        raw = np.column_stack([self.year.astype(float), self.filled['pv'],
+                               self.filled['lv'], self.gpm])
+        raw[:, 1:3][raw[:, 1:3] <= 0] = np.nan
+        scale = np.nanstd(raw, axis=0)
+        self.features = raw / np.where(scale > 0, scale, 1)
+
+        # the same in gpm order for nearest, where the cars below the
+        # emission thresholds are a prefix
+        self.by_gpm = np.argsort(self.gpm, kind='stable')
+        self.sorted_gpm = self.gpm[self.by_gpm]
+        self.sorted_features = np.asfortranarray(self.features[self.by_gpm])
+        self.sorted_codes = {col: self.codes[col][self.by_gpm]
+                             for col in self.CATEGORICAL}
+        self.sorted_codes['trany'] = self.trany_first[self.by_gpm]
+
+    def position(self, ids):
+        """
+        Finds the rows of the given ids.
+
+        Parameters:
+            ids (int or array): vehicle ids, all present in the catalog
+
+        Returns:
+            int or array: row positions in the catalog arrays
+        """
+        return np.searchsorted(self.ids, ids)
+
+    def decode(self, col, rows):
+        """
+        Returns the values of a categorical column at the given rows.
+        """
+        return np.asarray(self.categories[col])[self.codes[col][rows]]
+
+    def candidates(self, use_miles, gpm):
+        """
+        Mask of the cars recommend_cars considers: weekly emissions
+        below the average and below the user's current car.
+
+        Parameters:
+            use_miles (float): estimation for user's weekly milage
+            gpm (float): grams of CO2 emitted per mile by the user's car
+
+        Returns:
+            np.array: boolean mask over the catalog rows
+        """
+        if use_miles <= 0: # nothing emits less than the user's 0 grams
+            return np.zeros(len(self.ids), dtype=bool)
+        threshold = cscc.AVG_EMISSION / cscc.WEEKS_IN_YEAR / use_miles
+        return (self.gpm <= threshold) & (self.gpm < gpm)
+
+    def frame(self, rows, co2, index=None):
+        """
+        Builds the DataFrame recommend_cars returns for the given rows.
+
+        Parameters:
+            rows (array): catalog row positions
+            co2 (array): co2_emission value of each row
+            index (array): index labels of the frame
+
+        Returns:
+            pd.DataFrame: one row per position, in order
+        """
+        data = {'id': self.ids[rows], 'make': self.decode('make', rows),
+                'model': self.model[rows]}
+        data.update((col, vals[rows]) for col, vals in self.volumes.items())
+        data.update({'fuelType': self.decode('fuelType', rows),
+                     'VClass': self.decode('VClass', rows),
+                     'co2_emission': co2, 'year': self.year[rows],
+                     'trany': self.decode('trany', rows),
+                     'pv': self.filled['pv'][rows],
+                     'lv': self.filled['lv'][rows]})
+        return pd.DataFrame(data, columns=self.FRAME_COLS, index=index)
+
+    def recommend(self, id_, use_miles, rank_order, gpm):
+        """
+        Same as recommend_cars, evaluated over the catalog arrays.
+        The user's car is the last row of the working set, as in
+        recommend_cars, and the preference masks go through the same
+        filter_prefs cascade.
+
+        Parameters:
+            id_ (int): unique identifier for user's current car
+            use_miles (float): estimation for user's weekly milage
+            rank_order (lst): ordered list of attributes the user
+              wants to keep from their current car
+            gpm (float): grams of CO2 emitted per mile by the user's car
+
+        Returns:
+            pandas.DataFrame: dataframe with cars to recommend
+        """
+        if gpm == 0:
+            return "Your carbon emission is 0 - no recommendations were found!"
+
+        car = self.position(id_)
+        rows = np.append(np.flatnonzero(self.candidates(use_miles, gpm)), car)
+        co2 = np.append(self.gpm[rows[:-1]] * use_miles, np.nan)
+        labels = np.arange(len(rows))
+        car_v = {type_: max(self.volumes[col][car] for col in cols)
+                 for type_, cols in cscc.VOLUME_COLS.items()}
+
+        def mask_for(of_interest):
+            if of_interest in ['make', 'VClass', 'fuelType']:
+                code = self.codes[of_interest][car]
+                return (self.codes[of_interest][rows] == code) & (code != -1)
+            if of_interest == 'year':
+                return ((self.year[rows] >= self.year[car] - 5)
+                        & (self.year[rows] <= self.year[car] + 5))
+            if of_interest == 'trany':
+                code = self.trany_first[car]
+                return (self.trany_first[rows] == code) & (code != -1)
+            type_ = 'lv' if of_interest == 'luggage_volume' else 'pv'
+            if car_v[type_] == 0:
+                car_v[type_] = self.volume(id_, type_)
+            if car_v[type_] == 0:
+                return None
+            v = self.filled[type_][rows]
+            return (v >= car_v[type_] * 0.95) & (v <= car_v[type_] * 1.05)
+
+        keep = cscc.filter_prefs(rank_order, cscc.MaskCache(mask_for),
+                                 len(rows))
+        rows, co2, labels = rows[keep], co2[keep], labels[keep]
+
+        if len(rows) > cscc.CAR_LIMIT:
+            # same five year fuel savings and ranking as recommend_cars
+            others = np.flatnonzero(self.ids[rows] != id_)
+            costs = self.cost_per_mile[rows[others]] * use_miles
+            savings = (self.cost_per_mile[car] * use_miles - costs
+                       ) * cscc.WEEKS_IN_YEAR * 5
+            pick = others[cscc.top_k(savings, cscc.CAR_LIMIT)]
+            rows = np.append(rows[pick], car)
+            co2 = np.append(co2[pick], np.nan)
+            return self.frame(rows, co2)
+        return self.frame(rows, co2, labels)
+
+    def volume(self, id_, type_):
+        """
+        Same as get_volume: the luggage or passenger volume of a car,
+        as filled in by build_db when its own entry is missing.
+
+        Parameters:
+            id_ (int): unique identifier for user's current car
+            type_ (str): "lv" for luggage or "pv" for passenger volume
+
+        Returns:
+            float: volume in cubic feet
+        """
+        return self.filled[type_][self.position(id_)]
+
+    def savings(self, id_, use_miles, df):
+        """
+        Same as get_savings, looking fuel costs up in the catalog.
+
+        Parameters:
+            id_ (int): unique identifier for user's current car
+            use_miles (float): estimation for user's weekly milage
+            df (df): filtered dataframe of recommended cars we will add to
+
+        Returns:
+            df: same dataframe with new columns
+        """
+        old_weekly_cost = self.cost_per_mile[self.position(id_)] * use_miles
+        old_yearly_cost = old_weekly_cost * cscc.WEEKS_IN_YEAR
+        df.loc[:, "weekly_cost"] = (
+            self.cost_per_mile[self.position(df.id.to_numpy())] * use_miles)
+        df.loc[:, "yearly_cost"] = (df.loc[:, "weekly_cost"]
+                                    * cscc.WEEKS_IN_YEAR)
+        df.loc[:, "weekly_savings"] = (old_weekly_cost
+                                       - df.loc[:, "weekly_cost"])
+        df.loc[:, "yearly_savings"] = (old_yearly_cost
+                                       - df.loc[:, "yearly_cost"])
+        return df
+
+    def similar(self, id_, use_miles, rank_order, gpm, k=cscc.CAR_LIMIT):
+        """
+        Alternative to recommend: the k cars found by nearest, most
+        similar first, with the user's car as the last row.
+
+        Parameters:
+            id_ (int): unique identifier for user's current car
+            use_miles (float): estimation for user's weekly milage
+            rank_order (lst): ordered list of attributes the user
+              wants to keep from their current car
+            gpm (float): grams of CO2 emitted per mile by the user's car
+            k (int): number of cars to recommend
+
+        Returns:
+            pandas.DataFrame: dataframe with cars to recommend
+        """
+        if gpm == 0:
+            return "Your carbon emission is 0 - no recommendations were found!"
+        rows = np.append(self.nearest(id_, use_miles, rank_order, gpm, k),
+                         self.position(id_))
+        co2 = np.append(self.gpm[rows[:-1]] * use_miles, np.nan)
+        return self.frame(rows, co2)
+
+    def nearest(self, id_, use_miles, rank_order, gpm, k=cscc.CAR_LIMIT):
+        """
+        Finds the k cars below the emission thresholds of
+        recommend_cars that are most similar to the user's car.
+
+        Make, vehicle class, fuel type and transmission preferences are
+        exact-match constraints, applied in rank order and skipped if
+        they would leave fewer than k cars. Year and volume preferences
+        are features of a weighted distance, the higher ranked the
+        heavier, plus a small weight on gpm so that among equally
+        similar cars the cleaner ones come first. Ties are broken by
+        id, so the result only depends on the inputs.
+
+        Parameters:
+            id_ (int): unique identifier for user's current car
+            use_miles (float): estimation for user's weekly milage
+            rank_order (lst): ordered list of attributes the user
+              wants to keep from their current car
+            gpm (float): grams of CO2 emitted per mile by the user's car
+            k (int): number of cars to find
+
+        Returns:
+            np.array: catalog row positions, most similar first
+        """
+        car = self.position(id_)
+        if use_miles <= 0: # nothing emits less than the user's 0 grams
+            return np.array([], dtype=int)
+        threshold = cscc.AVG_EMISSION / cscc.WEEKS_IN_YEAR / use_miles
+        end = min(np.searchsorted(self.sorted_gpm, threshold, 'right'),
+                  np.searchsorted(self.sorted_gpm, gpm, 'left'))
+        mask = np.ones(end, dtype=bool)
+        codes = {col: self.codes[col][car] for col in self.CATEGORICAL}
+        codes['trany'] = self.trany_first[car]
+        weights = np.zeros(self.features.shape[1])
+        weights[-1] = self.GPM_WEIGHT
+
+        for rank, of_interest in enumerate(rank_order):
+            if of_interest in self.FEATURES:
+                weights[self.FEATURES[of_interest]] = len(rank_order) - rank
+                continue
+            code = codes[of_interest]
+            if code == -1:
+                continue
+            keep = mask & (self.sorted_codes[of_interest][:end] == code)
+            if np.count_nonzero(keep) >= k:
+                mask = keep
+
+        target = self.features[car].copy()
+        target[-1] = 0
+        weights[np.isnan(target)] = 0 # user's volume unknown, can't compare
+        rows = np.flatnonzero(mask)
+        dist = np.zeros(len(rows))
+        for col in np.flatnonzero(weights):
+            diff = np.abs(self.sorted_features[rows, col] - target[col])
+            diff[np.isnan(diff)] = self.MISSING
+            dist += weights[col] * diff ** 2
+
+        if len(rows) > k:
+            # everything tied with the k-th distance, then sort by id
+            kth = np.partition(dist, k - 1)[k - 1]
+            near = dist <= kth
+            rows, dist = rows[near], dist[near]
+        rows = self.by_gpm[rows]
+        return rows[np.lexsort((self.ids[rows], dist))[:k]]
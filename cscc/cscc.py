@@ -4,19 +4,54 @@
 #
 # Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
 
-import io
+import os
 import re
-import bs4
-import urllib3
-import certifi
+import sys
+import csv
+import html as html_lib
+import json
+import time
+import bisect
+import tempfile
+import itertools
+import threading
+import functools
+import contextlib
+import importlib
+import concurrent.futures
 import sqlite3
 from sqlite3.dbapi2 import Error
-import pandas as pd
-import numpy as np
 
 import questionary as q
 from questionary import ValidationError
 from questionary import Style
+from prompt_toolkit.completion import Completer, Completion
+
+
+class LazyModule:
+    """
+    Stands in for a module until it is first used, so the prompts
+    don't wait for pandas, numpy and urllib3 to load. The first
+    attribute looked up imports the module and puts it in this module's
+    globals in place of the stand-in, so later uses cost nothing extra.
+
+    Parameters:
+        alias (str): global name the module is used under
+        name (str): module to import
+    """
+    def __init__(self, alias, name):
+        self._alias, self._name = alias, name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+pd = LazyModule('pd', 'pandas')
+np = LazyModule('np', 'numpy')
+urllib3 = LazyModule('urllib3', 'urllib3')
+certifi = LazyModule('certifi', 'certifi')
 
 
 URL = "https://www.fueleconomy.gov/feg/epadata/vehicles.csv"
@@ -24,6 +59,50 @@ DATA_COLS = ['id', 'make', 'model', 'year', 'trany', 'drive', 'cylinders',
              'VClass', 'pv2', 'pv4', 'hpv', 'lv2', 'lv4', 'hlv', 'fuelCost08',
              'fuelCostA08', 'fuelType', 'co2TailpipeGpm', 'co2TailpipeAGpm']
 WHERE_CMD = "WHERE make = ? AND model = ? AND year = ?"
+VEHICLES_SCHEMA = ('CREATE TABLE {} (id INTEGER PRIMARY KEY, '
+                   'make TEXT, model TEXT, year INTEGER, trany TEXT, '
+                   'drive TEXT, cylinders REAL, VClass TEXT, pv2 INTEGER, '
+                   'pv4 INTEGER, hpv INTEGER, lv2 INTEGER, lv4 INTEGER, '
+                   'hlv INTEGER, fuelCost08 INTEGER, fuelCostA08 INTEGER, '
+                   'fuelType TEXT, co2TailpipeGpm REAL, co2TailpipeAGpm REAL, '
+                   'gpm REAL, family TEXT, pv REAL, lv REAL, '
+                   'trany_family TEXT)')
+# columns computed from the csv ones once the whole table is loaded
+DERIVED_COLS = [('gpm', 'REAL'), ('family', 'TEXT'), ('pv', 'REAL'),
+                ('lv', 'REAL'), ('trany_family', 'TEXT')]
+VOLUME_COLS = {'pv': ['pv2', 'pv4', 'hpv'], 'lv': ['lv2', 'lv4', 'hlv']}
+# effective co2 grams per mile, averaging both fuels for dual fuel cars
+GPM_SQL = ('CASE WHEN co2TailpipeAGpm '
+           'THEN (co2TailpipeGpm + co2TailpipeAGpm) / 2 '
+           'ELSE co2TailpipeGpm END')
+FIRST_WORD_SQL = ("CASE WHEN instr({0}, ' ') "
+                  "THEN substr({0}, 1, instr({0}, ' ') - 1) ELSE {0} END")
+# first word of the model name, shared by all variants of a model
+FAMILY_SQL = FIRST_WORD_SQL.format('model')
+# first word of the transmission, e.g. Automatic or Manual
+TRANY_FAMILY_SQL = FIRST_WORD_SQL.format('trany')
+VEHICLES_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_make_model_year '
+    'ON vehicles (make, model, year)',
+    'CREATE INDEX IF NOT EXISTS idx_variant '
+    'ON vehicles (make, model, year, trany, cylinders, drive)',
+    'CREATE INDEX IF NOT EXISTS idx_family ON vehicles (make, family, year)']
+DROPPED_INDEXES = ['idx_gpm'] #made by older versions, no query uses them
+CHUNK_SIZE = 5000 #csv rows read and written to the db at a time
+MAX_PARAMS = 900 #parameters per query, under sqlite's lowest default limit
+VARIANT_COLS = ['id', 'trany', 'cylinders', 'drive'] #of build_choices variants
+CATEGORY_COLS = ['make', 'model', 'trany', 'trany_family', 'drive', 'VClass',
+                 'fuelType'] #categoricals of vehicle_frame
+VEHICLE_DTYPES = {'id': 'int32', 'year': 'int16', 'cylinders': 'float32',
+                  'pv2': 'int16', 'pv4': 'int16', 'hpv': 'int16',
+                  'lv2': 'int16', 'lv4': 'int16', 'hlv': 'int16',
+                  'pv': 'float64', 'lv': 'float64', 'gpm': 'float32',
+                  'fuelCost08': 'int32',
+                  'fuelCostA08': 'int32'} #of vehicle_frame
+RANK_PREFS = ['make', 'year', 'trany', 'VClass', 'fuelType',
+              'passenger_volume', 'luggage_volume'] #what rank_pref can return
+REC_COLS = ['id', 'make', 'model', 'year', 'co2_emission', 'weekly_savings',
+            'yearly_savings'] #recommendation columns of batch and server
 
 AVG_EMISSION = 4600000 #g/year
 CAR_LIMIT = 20 #number of cars to reduce to before checking prices, can lower
@@ -31,6 +110,29 @@ MIN_LIMIT = 3
 WEEKS_IN_YEAR = 52
 YEARLY_MILES = 15000
 
+KBB_URL = "https://www.kbb.com/{}/{}/{}/"
+PRICE_WORKERS = CAR_LIMIT + 1 #threads used to crawl prices concurrently
+HOST_LIMIT = 8 #max simultaneous connections to a single host
+PREFETCH_LIMIT = CAR_LIMIT #likely recommendations priced while ranking
+PRICE_DEADLINE = 30 #seconds the streaming mode waits for prices at most
+KBB_TIMEOUT = (3.05, 10) #connect and read timeouts of a kbb request, seconds
+KBB_RETRIES = 2 #extra attempts at a request after a timeout or server error
+KBB_REDIRECTS = 5 #redirects followed within one attempt at a request
+RETRY_BACKOFF = 0.5 #seconds before the first retry, doubling after that
+FETCH_BUDGET = 20 #seconds all the requests for one car's price may take
+BREAKER_FAILURES = 5 #failed requests in a row that stop requests to kbb
+BREAKER_COOLDOWN = 60 #seconds requests stay stopped before kbb is tried again
+PRICE_TTL = 7 * 24 * 60 * 60 #seconds a cached price (or miss) stays fresh
+SLUG_TTL = PRICE_TTL #seconds before a slug with no page is tried again
+SLUG_STATS = {"lookups": 0, "hits": 0, "fetches": 0} #slug table usage counters
+SLUG_LOCK = threading.Lock() #guards SLUG_STATS, counted from several threads
+CRAWLER = None #Crawler shared by every price lookup, see get_crawler
+TRACE = None #Trace of the session when run with trace, see Trace
+TRACE_STEPS = 100 #sqlite VM steps between a traced statement's timings
+TRACE_FILE = 'cscc-trace-{}.json' #where a trace is saved, with the time
+TITLE_RE = re.compile(rb'<title[^>]*>(.*?)</title', re.S | re.I)
+PRICE_RE = re.compile(rb'"price":"([0-9]+)"')
+
 # Style options for terminal questions
 S_CONFIG = [('qmark', 'fg:#A0E8AF'),             # token in front of the question
             ('question', 'fg:#EDEAD0 bold'),     # question text
@@ -44,19 +146,523 @@ S_CONFIG = [('qmark', 'fg:#A0E8AF'),             # token in front of the questio
             ('disabled', 'fg:#858585 italic')]   # disabled choices for select and checkbox prompts
 
 
-def build_db(connection):
+@functools.lru_cache(maxsize=None)
+def prompt_style(qmark=None):
+    """
+    Builds the Style of the terminal questions once and reuses it.
+
+    Parameters:
+        qmark (str): style of the token in front of the question, in
+          place of S_CONFIG's
+
+    Returns:
+        Style: S_CONFIG's style
+    """
+    return Style(S_CONFIG + ([('qmark', qmark)] if qmark else []))
+
+
+def build_db(connection, source=URL, chunksize=CHUNK_SIZE):
     """
     Creates sqlite database file containing only the columns
     relevant for our use from the original vehicle csv.
-    Fetches csv directly from constant URL and filters by
-    constant DATA_COLS.
+    Fetches csv from constant URL (or a local, optionally gzipped,
+    file) and filters by constant DATA_COLS. The csv is read and
+    written in chunks into a staging table that replaces the vehicles
+    table once complete, so memory use stays bounded and readers never
+    see a half built table. When downloading, the file is only fetched
+    again if it changed since the last build.
+
+    Parameters:
+        connection (obj): connection object for db file
+        source (str): url or path of the vehicle csv, defaults to URL
+        chunksize (int): number of csv rows written per transaction
+
+    Returns:
+        bool: True if the table was rebuilt, False if the upstream
+            file has not changed
+    """
+    validators = stage_csv(connection, source, chunksize)
+    if validators is None:
+        return False
+    with connection:
+        connection.execute('BEGIN')
+        connection.execute('DROP TABLE IF EXISTS vehicles')
+        connection.execute('ALTER TABLE vehicles_new RENAME TO vehicles')
+        save_download(connection, source, validators)
+    index_db(connection)
+    return True
+
+
+def refresh_db(connection, source=URL, chunksize=CHUNK_SIZE):
+    """
+    Brings the vehicles table up to date with a new copy of the
+    vehicle csv without replacing it. The csv is staged the same way
+    build_db does, then compared with the current table by id: new
+    ids are inserted, rows whose values changed are updated and ids
+    no longer in the csv are deleted, all in one short transaction.
+    A table built by an older version is migrated first.
+
+    Parameters:
+        connection (obj): connection object for db file
+        source (str): url or path of the vehicle csv, defaults to URL
+        chunksize (int): number of csv rows written per transaction
+
+    Returns:
+        dict: number of rows inserted, updated and deleted, or None if
+            the upstream file has not changed
+    """
+    built = connection.execute('SELECT 1 FROM sqlite_master '
+                               "WHERE name = 'vehicles'").fetchone()
+    if not built:
+        if not build_db(connection, source, chunksize):
+            return None
+        total = connection.execute('SELECT count(*) FROM vehicles')
+        return {'inserted': total.fetchone()[0], 'updated': 0, 'deleted': 0}
+    migrate_db(connection) # tables built by older versions lack columns
+
+    validators = stage_csv(connection, source, chunksize)
+    if validators is None:
+        return None
+    cols = ([col for col in DATA_COLS if col != 'id']
+            + [col for col, _ in DERIVED_COLS])
+    changed = ' OR '.join(f'v.{col} IS NOT n.{col}' for col in cols)
+    counts = {}
+    with connection:
+        connection.execute('BEGIN')
+        counts['deleted'] = connection.execute(
+            'DELETE FROM vehicles WHERE id NOT IN '
+            '(SELECT id FROM vehicles_new)').rowcount
+        counts['updated'] = connection.execute(
+            f'UPDATE vehicles AS v SET ({", ".join(cols)}) = '
+            f'({", ".join("n." + col for col in cols)}) '
+            f'FROM vehicles_new AS n WHERE v.id = n.id AND ({changed})'
+            ).rowcount
+        counts['inserted'] = connection.execute(
+            f'INSERT INTO vehicles (id, {", ".join(cols)}) '
+            f'SELECT id, {", ".join(cols)} FROM vehicles_new '
+            'WHERE id NOT IN (SELECT id FROM vehicles)').rowcount
+        connection.execute('DROP TABLE vehicles_new')
+        save_download(connection, source, validators)
+    if any(counts.values()):
+        index_db(connection)
+    return {key: counts[key] for key in ('inserted', 'updated', 'deleted')}
+
+
+def stage_csv(connection, source, chunksize):
+    """
+    Loads the vehicle csv into a vehicles_new table in chunks, one
+    transaction per chunk, downloading it first if source is a url.
+
+    Parameters:
+        connection (obj): connection object for db file
+        source (str): url or path of the vehicle csv
+        chunksize (int): number of csv rows written per transaction
+
+    Returns:
+        tup: (etag, last modified) values of the download, empty for a
+            local file, or None if the upstream file has not changed
+    """
+    path, validators = source, ()
+    if source.startswith(('http://', 'https://')):
+        fetched = download_csv(connection, source)
+        if fetched is None:
+            return None
+        path, validators = fetched
+    try:
+        # .to_sql cannot create a table with a primary key, so the table
+        # is created first and only appended to
+        connection.execute('DROP TABLE IF EXISTS vehicles_new')
+        connection.execute(VEHICLES_SCHEMA.format('vehicles_new'))
+        for chunk in pd.read_csv(path, usecols=DATA_COLS, index_col='id',
+                                 engine='c', chunksize=chunksize):
+            chunk.to_sql('vehicles_new', con=connection, if_exists='append')
+        derive_cols(connection, 'vehicles_new')
+    finally:
+        if path != source:
+            os.remove(path)
+    return validators
+
+
+def save_download(connection, url, validators):
+    """
+    Remembers the ETag and Last-Modified values of a downloaded csv
+    so the next download of url can be skipped if nothing changed.
+
+    Parameters:
+        connection (obj): connection object for db file
+        url (str): url of the vehicle csv
+        validators (tup): (etag, last modified), empty for local files
+    """
+    if validators:
+        connection.execute('INSERT OR REPLACE INTO downloads '
+                           'VALUES (?, ?, ?)', (url,) + validators)
+
+
+def download_csv(connection, url):
+    """
+    Streams the vehicle csv to a temporary file. If the database
+    already holds a table built from this url, the request carries
+    the ETag and Last-Modified values saved from that download so the
+    server can answer that nothing changed.
+
+    Parameters:
+        connection (obj): connection object for db file
+        url (str): url of the vehicle csv
+
+    Returns:
+        tup: path of the temporary file and the (etag, last modified)
+            values of the response, or None if the file has not changed
+    """
+    connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                       'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)')
+    headers = {}
+    built = connection.execute('SELECT 1 FROM sqlite_master '
+                               "WHERE name = 'vehicles'").fetchone()
+    saved = connection.execute('SELECT etag, last_modified FROM downloads '
+                               'WHERE url = ?', (url,)).fetchone()
+    if built and saved:
+        if saved[0]:
+            headers['If-None-Match'] = saved[0]
+        if saved[1]:
+            headers['If-Modified-Since'] = saved[1]
+
+    pm = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',
+                             ca_certs=certifi.where())
+    r = pm.request('GET', url, headers=headers, preload_content=False)
+    try:
+        if r.status == 304:
+            return None
+        if r.status != 200:
+            raise urllib3.exceptions.HTTPError(f'{url} returned {r.status}')
+        suffix = '.csv.gz' if url.endswith('.gz') else '.csv'
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            for data in r.stream(2 ** 16):
+                f.write(data)
+    finally:
+        r.release_conn()
+    return f.name, (r.headers.get('ETag'), r.headers.get('Last-Modified'))
+
+
+def index_db(connection):
+    """
+    Creates the lookup indexes on the vehicles table and refreshes
+    the statistics the query planner uses to pick them, as well as
+    the choices get_id offers and the categories of vehicle_frame.
+
+    Parameters:
+        connection (obj): connection object for db file
+    """
+    for cmd in VEHICLES_INDEXES:
+        connection.execute(cmd)
+    connection.execute('ANALYZE')
+    save_choices(connection, build_choices(connection))
+    save_json(connection, 'categories', build_categories(connection))
+    connection.commit()
+
+
+def build_choices(connection):
+    """
+    Reads the makes, model years and variants get_id asks the user to
+    pick from in one pass over the vehicles table.
+
+    Parameters:
+        connection (obj): connection object for db file
+
+    Returns:
+        dict: 'makes' (sorted lst of makes), 'model_years' (make ->
+            lst of "model year" strings, by model then newest first)
+            and 'variants' (make -> "model year" -> lst of [id, trany,
+            cylinders, drive] lists in id order)
+    """
+    rows = connection.execute('SELECT make, model, year, id, trany, '
+                              'cylinders, drive FROM vehicles '
+                              'ORDER BY make, model, year, id').fetchall()
+    model_years, variants = {}, {}
+    for make, make_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        variants[make] = {}
+        for (model, year), group in itertools.groupby(
+                make_rows, key=lambda row: row[1:3]):
+            variants[make][f'{model} {year}'] = [list(row[3:])
+                                                  for row in group]
+        model_years[make] = sorted(variants[make], key=lambda m_y: (
+            m_y.rpartition(' ')[0], -int(m_y.rpartition(' ')[2])))
+    return {'makes': sorted(variants), 'model_years': model_years,
+            'variants': variants}
+
+
+def build_categories(connection):
+    """
+    Reads the distinct values of each of the CATEGORY_COLS, the
+    categories every vehicle_frame shares.
+
+    Parameters:
+        connection (obj): connection object for db file
+
+    Returns:
+        dict: column -> sorted lst of its values
+    """
+    return {col: [value for value, in connection.execute(
+                f'SELECT DISTINCT {col} FROM vehicles WHERE {col} IS NOT NULL '
+                f'ORDER BY {col}')]
+            for col in CATEGORY_COLS}
+
+
+def save_json(connection, table, data):
+    """
+    Stores data computed from the vehicles table in a table of its
+    own, so sessions can load it instead of computing it again. It is
+    kept as JSON, which reads back the same whatever the Python and
+    pandas versions (tuples come back as lists).
+
+    Parameters:
+        connection (obj): connection object for db file
+        table (str): name of the table holding it
+        data (obj): dicts, lists, strings and numbers
+    """
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (data TEXT)')
+    connection.execute(f'DELETE FROM {table}')
+    connection.execute(f'INSERT INTO {table} VALUES (?)', (json.dumps(data),))
+
+
+def load_json(conn, table, build):
+    """
+    Loads the data saved by save_json, building it if the database
+    predates it or holds something else, like the pickles older
+    versions saved (and saving it too, if it can be written to).
+
+    Parameters:
+        conn (obj): connection to sqlite database we will be querying
+        table (str): name of the table holding it
+        build (function): computes it from a connection
+
+    Returns:
+        obj: the data
+    """
+    try:
+        row = conn.execute(f'SELECT data FROM {table}').fetchone()
+    except sqlite3.OperationalError: # no such table yet
+        row = None
+    if row:
+        try:
+            return json.loads(row[0])
+        except (ValueError, TypeError): # not JSON, e.g. an old pickle
+            pass
+    data = build(conn)
+    try:
+        with conn:
+            save_json(conn, table, data)
+    except sqlite3.OperationalError: # read only database
+        pass
+    return data
+
+
+def save_choices(connection, choices):
+    """
+    Stores the output of build_choices in the database.
+
+    Parameters:
+        connection (obj): connection object for db file
+        choices (dict): output of build_choices
+    """
+    save_json(connection, 'choices', choices)
+
+
+def load_choices(conn):
+    """
+    Loads the choices saved by index_db, building them if the
+    database has none.
+
+    Parameters:
+        conn (obj): connection to sqlite database we will be querying
+
+    Returns:
+        dict: output of build_choices
+    """
+    return load_json(conn, 'choices', build_choices)
+
+
+def load_categories(conn):
+    """
+    Loads the categories saved by index_db, building them if the
+    database has none.
+
+    Parameters:
+        conn (obj): connection to sqlite database we will be querying
+
+    Returns:
+        dict: column -> pandas.CategoricalDtype of build_categories' values
+    """
+    return {col: pd.CategoricalDtype(values) for col, values
+            in load_json(conn, 'categories', build_categories).items()}
+
+
+def vehicle_frame(rows, cols, categories, dtypes=None):
+    """
+    Typed loader for rows of the vehicles table. The CATEGORY_COLS
+    become categoricals sharing the database's categories, so equality
+    filters compare integer codes, and the numeric columns get the
+    small VEHICLE_DTYPES (float32 for integer columns holding NULLs).
+    Other columns are left for pandas to infer.
+
+    Parameters:
+        rows (lst): tuples of values, e.g. from fetchall()
+        cols (lst): column names of the values
+        categories (dict): output of load_categories
+        dtypes (dict): column -> dtype to use instead of VEHICLE_DTYPES
+
+    Returns:
+        pandas.DataFrame: the rows
+    """
+    dtypes = {**VEHICLE_DTYPES, **(dtypes or {})}
+    data = {}
+    for col, values in zip(cols, zip(*rows) if rows else [()] * len(cols)):
+        if col in CATEGORY_COLS:
+            codes = categories[col].categories.get_indexer(
+                np.array(values, dtype=object))
+            if np.count_nonzero(codes == -1) > values.count(None):
+                # a value the saved categories lack, unshared categories
+                data[col] = pd.Categorical(values)
+            else:
+                data[col] = pd.Categorical.from_codes(codes,
+                                                      dtype=categories[col])
+        elif col in dtypes:
+            dtype = dtypes[col]
+            if dtype.startswith('int') and None in values:
+                dtype = 'float32'
+            data[col] = np.array(values, dtype=dtype)
+        else:
+            data[col] = list(values)
+    return pd.DataFrame(data, columns=cols)
+
+
+def plain_frame(df, rows, cols):
+    """
+    Takes some rows of a vehicle_frame with the dtypes pandas would have
+    inferred from the database's values, so the categoricals are strings
+    again, for the few cars that go on to be priced and shown.
+
+    Parameters:
+        df (pandas.DataFrame): output of vehicle_frame
+        rows (np.array): positions of the rows to take
+        cols (lst): columns to take
+
+    Returns:
+        pandas.DataFrame: the rows, keeping their index
+    """
+    return pd.DataFrame({col: np.asarray(df[col])[rows].tolist()
+                         for col in cols}, index=df.index[rows], columns=cols)
+
+
+def derive_cols(connection, table):
+    """
+    Computes the DERIVED_COLS of every row of a vehicles table: its
+    effective co2 grams per mile, its model and transmission families
+    and its passenger and luggage volume. A car with no volume
+    information takes, for each volume column, the average of the non
+    zero values of cars with the same make and family within four
+    years of it, and then the largest of those averages, or 0 if there
+    are no such cars.
+    These are found for every make, family and year at once: the non
+    zero values are summed and counted once per year, then the sums
+    and counts of the years within four years of each are added up.
 
     Parameters:
         connection (obj): connection object for db file
+        table (str): name of the table to fill in
+    """
+    all_cols = [col for cols in VOLUME_COLS.values() for col in cols]
+    per_year = ', '.join(f'total(CASE WHEN {col} > 0 THEN {col} END) '
+                         f'AS sum_{col}, '
+                         f'count(CASE WHEN {col} > 0 THEN 1 END) AS n_{col}'
+                         for col in all_cols)
+    window = ', '.join(f'sum(sum_{col}) OVER w AS sum_{col}, '
+                       f'sum(n_{col}) OVER w AS n_{col}' for col in all_cols)
+    fills = ', '.join('max({}) AS {}'.format(', '.join(
+                          f'CASE WHEN n_{col} THEN sum_{col} / n_{col} '
+                          'ELSE 0 END' for col in cols), type_)
+                      for type_, cols in VOLUME_COLS.items())
+    with connection:
+        connection.execute(f'UPDATE {table} SET gpm = {GPM_SQL}, '
+                           f'family = {FAMILY_SQL}, '
+                           f'trany_family = {TRANY_FAMILY_SQL}')
+        connection.execute('DROP TABLE IF EXISTS temp.volume_fill')
+        connection.execute(
+            f'CREATE TEMP TABLE volume_fill AS SELECT make, family, year, '
+            f'{fills} FROM (SELECT make, family, year, {window} '
+            f'FROM (SELECT make, family, year, {per_year} FROM {table} '
+            'GROUP BY make, family, year) '
+            'WINDOW w AS (PARTITION BY make, family ORDER BY year '
+            'RANGE BETWEEN 4 PRECEDING AND 4 FOLLOWING))')
+        connection.execute('CREATE INDEX temp.idx_volume_fill '
+                           'ON volume_fill (make, family, year)')
+        sets = []
+        for type_, cols in VOLUME_COLS.items():
+            own = f'max({", ".join("v." + col for col in cols)})'
+            sets.append(f'{type_} = CASE WHEN {own} > 0 THEN {own} '
+                        f'ELSE coalesce((SELECT f.{type_} FROM volume_fill '
+                        'AS f WHERE f.make = v.make AND f.family = v.family '
+                        'AND f.year = v.year), 0) END')
+        connection.execute(f'UPDATE {table} AS v SET {", ".join(sets)}')
+        connection.execute('DROP TABLE temp.volume_fill')
+
+
+def sibling_avgs(type_, prefix=''):
+    """
+    SQL aggregates giving, for each volume column of the given type,
+    the average of its non zero values, or 0 if there are none.
+
+    Parameters:
+        type_ (str): "lv" for luggage or "pv" for passenger volume
+        prefix (str): table alias to qualify the columns with
+
+    Returns:
+        lst: one aggregate expression per volume column
     """
-    df = pd.read_csv(URL, usecols=DATA_COLS, index_col='id', engine='c')
-    # IMPORTANT .to_sql cannot create a table with a primary key
-    df.to_sql('vehicles', con=connection, if_exists='replace')
+    return [f'coalesce(avg(CASE WHEN {prefix}{col} > 0 '
+            f'THEN {prefix}{col} END), 0)' for col in VOLUME_COLS[type_]]
+
+
+def migrate_db(connection):
+    """
+    Brings a cscc.db built by an older version up to the current
+    schema in place. A vehicles table written straight by .to_sql has
+    no primary key, so it is copied into a keyed table first, and
+    tables from before any of the DERIVED_COLS get them added and
+    filled in. Indexes no query uses any more are dropped.
+
+    Parameters:
+        connection (obj): connection object for db file
+    """
+    info = connection.execute('PRAGMA table_info(vehicles)').fetchall()
+    keyed = any(name == 'id' and pk for _, name, _, _, _, pk in info)
+    names = {name for _, name, _, _, _, _ in info}
+    missing = [(col, type_) for col, type_ in DERIVED_COLS
+               if col not in names]
+    with connection:
+        connection.execute('BEGIN')
+        if not keyed:
+            cols = ', '.join(DATA_COLS)
+            connection.execute('ALTER TABLE vehicles RENAME TO vehicles_old')
+            connection.execute(VEHICLES_SCHEMA.format('vehicles'))
+            connection.execute(f'INSERT INTO vehicles ({cols}) '
+                               f'SELECT {cols} FROM vehicles_old')
+            connection.execute('DROP TABLE vehicles_old')
+        else:
+            for col, type_ in missing:
+                connection.execute(f'ALTER TABLE vehicles '
+                                   f'ADD COLUMN {col} {type_}')
+    if not keyed or missing:
+        derive_cols(connection, 'vehicles')
+    for name in DROPPED_INDEXES:
+        if connection.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+                              (name,)).fetchone():
+            with connection:
+                connection.execute(f'DROP INDEX {name}')
+    indexes = connection.execute('SELECT count(*) FROM sqlite_master '
+                                 "WHERE type = 'index' AND name LIKE 'idx_%'"
+                                 ).fetchone()[0]
+    if not keyed or missing or indexes < len(VEHICLES_INDEXES):
+        index_db(connection)
 
 
 def get_id(conn):
@@ -64,7 +670,10 @@ def get_id(conn):
     Extracts unique id from database by narrowing down candidates based
     on user provided information. Some cars continue to have variants
     even after all questions have been asked. For those that do, the
-    first id fetched by the final query result is the one we will use.
+    lowest id of the variants left is the one we will use, the first
+    row a query of the database for them returns.
+    All the choices come from load_choices, so typing and validating
+    answers does not query the database.
 
     Parameters:
         conn (obj): connection to sqlite database we will be querying
@@ -74,33 +683,27 @@ def get_id(conn):
             access other information related to their vehicle for
             future functions
     """
-    c = conn.cursor()
-    make_query = 'SELECT DISTINCT make FROM vehicles'
-    make_results = c.execute(make_query).fetchall()
-    make_results = sorted({tup[0] for tup in make_results})
+    choices = load_choices(conn)
+    make_results = choices['makes']
+    valid_makes = set(make_results)
     make_ans = q.autocomplete("What is your car's make?\n   ",
                               choices=make_results,
+                              completer=PrefixCompleter(make_results),
                               validate=(lambda text:
-                                        autoc_validator(text, c, 'make')),
-                              style=Style(S_CONFIG), qmark='⯁ ').ask()
-
-    m_y_query = ('SELECT DISTINCT model, year '
-                 'FROM vehicles WHERE make = ?')
-    m_y_results = set(c.execute(m_y_query, (make_ans,)).fetchall())
-    m_y_results = sorted(m_y_results, key=lambda tup: (tup[0], -tup[1]))
-    m_y_results = [tup[0] + ' ' + str(tup[1]) for tup in m_y_results]
+                                        autoc_validator(text, valid_makes)),
+                              style=prompt_style(), qmark='⯁ ').ask()
+
+    m_y_results = choices['model_years'][make_ans]
+    variants = choices['variants'][make_ans]
     m_y_ans = q.autocomplete('What about model and year?\n   ',
                              choices=m_y_results,
+                             completer=PrefixCompleter(m_y_results),
                              validate=(lambda text:
-                                       autoc_validator(text, c, 'm_y')),
-                             style=Style(S_CONFIG), qmark='\n⯁ ').ask()
-    model,_ , year = m_y_ans.rpartition(' ')
-
-    base_tup = (make_ans, model, int(year))
-    id_query = f'SELECT id FROM vehicles {WHERE_CMD}'
-    uniq_results = c.execute(id_query, base_tup).fetchall()
-    uniq_results = [tup[0] for tup in uniq_results]
-    id_ = uniq_results[0]
+                                       autoc_validator(text, variants)),
+                             style=prompt_style(), qmark='\n⯁ ').ask()
+
+    uniq_results = variants[m_y_ans]
+    id_ = first_id(uniq_results)
     uniq = len(uniq_results) == 1
     c_msg = ('Your particular car has some variants, would you like to be '
              'more specific?\n   You may be prompted to choose transmission, '
@@ -108,25 +711,21 @@ def get_id(conn):
              'you are comfortable with these more advanced options.\n   '
              '(Skipping defaults to No.)\n   ')
     advanced = q.confirm(c_msg, default=False,
-                         style=Style(S_CONFIG + [('qmark', 'fg:#CF5050')]),
+                         style=prompt_style('fg:#CF5050'),
                          qmark='\n❗').skip_if(uniq).ask()
 
     if advanced:
-        t_ans, _ = unique_helper(c, 'trany', 'transmission', base_tup)
-        c_ans, _ = unique_helper(c, 'cylinders', 'number of cylinders',
-                                 base_tup, [('trany', t_ans)])
-        d_ans, cond = unique_helper(c, 'drive', 'drive type', base_tup,
-                                    [('trany', t_ans), ('cylinders', c_ans)])
-        if d_ans:
-            cond += ' AND drive = ?'
-        add_tup = tuple(val for val in (t_ans, c_ans, d_ans) if val)
-        id_query = 'SELECT id FROM vehicles ' + WHERE_CMD + cond
-        id_ = c.execute(id_query, base_tup + add_tup).fetchone()[0]
-    c.close()
+        t_ans = unique_helper(uniq_results, 'trany', 'transmission')
+        c_ans = unique_helper(uniq_results, 'cylinders',
+                              'number of cylinders', [('trany', t_ans)])
+        answers = [('trany', t_ans), ('cylinders', c_ans)]
+        d_ans = unique_helper(uniq_results, 'drive', 'drive type', answers)
+        id_ = first_id(matching_variants(uniq_results,
+                                         answers + [('drive', d_ans)]))
     return id_
 
 
-def autoc_validator(text, cursor, query):
+def autoc_validator(text, valid):
     """
     Checks if the car details being inputted are valid,
     does not let user submit if it isn't in the local database.
@@ -134,9 +733,8 @@ def autoc_validator(text, cursor, query):
     Parameters:
         text (str): user's input, updates as it changes allowing
             for real time validation, unlike python's input()
-        cursor (obj): cursor for database we will be querying
-        query (str): checked to determine what car detail to query
-            for validation, the make or the model and year
+        valid (set or dict): the makes, or model and years, in the
+            database to check against
 
     Returns:
         bool: True if valid
@@ -145,62 +743,141 @@ def autoc_validator(text, cursor, query):
         ValidationError: Raises instead of returning False, this
             allows for questionary to properly display validator msg
     """
-    if query == 'make':
-        exists_query = 'SELECT EXISTS (SELECT 1 FROM vehicles WHERE make = ?)'
-    elif query == 'm_y':
-        exists_query = ('SELECT EXISTS (SELECT 1 FROM vehicles '
-                        'WHERE model || " " || year = ?)')
-    exists = cursor.execute(exists_query, (text,)).fetchone()[0]
-    if not exists:
+    if text not in valid:
         raise ValidationError(
             message='Current entry does not match database!'
         )
     return True
 
 
-def unique_helper(c, col, col_desc, base_param, prev=[]):
+class PrefixCompleter(Completer):
+    """
+    Completes an answer from a list of choices the way questionary's
+    autocomplete does, ignoring case and matching in the middle of a
+    choice too, but finds the choices starting with the text typed
+    by bisecting a sorted copy instead of testing every one of them,
+    and lists those first.
+    """
+    def __init__(self, choices):
+        self.keys = sorted((choice.lower(), choice) for choice in choices)
+        self.lowered = [key for key, _ in self.keys]
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor.lower()
+        start = bisect.bisect_left(self.lowered, text)
+        end = bisect.bisect_left(self.lowered, text + '\uffff', start)
+        for _, choice in self.keys[start:end]:
+            yield Completion(choice, start_position=-len(choice))
+        if text:
+            for key, choice in itertools.chain(self.keys[:start],
+                                               self.keys[end:]):
+                if text in key:
+                    yield Completion(choice, start_position=-len(choice))
+
+
+def unique_helper(variants, col, col_desc, prev=[]):
     """
     Refines id search by checking if transmission, cylinder, or drive
     data is enough to uniquely identify a given car.
 
     Parameters:
-        c (obj): cursor for current connection to database
+        variants (lst): [id, trany, cylinders, drive] lists of the
+            make, model and year chosen, from load_choices
         col (str): column we will query for uniqueness
         col_desc (str): modifies question string to best fit
             current query
-        base_param (tup): make, model, year used as filters for
-            query. These parameters are built upon as each
-            successive question provides new information
         prev (lst): contains tuples of form
             (prev col queried, prev unique_helper result)
             needed so that later calls to this function may
             use new information to refine its query
     
     Returns:
-        tup:ans (str) - the feature selected by the user that matches
+        str: the feature selected by the user that matches
             their current car. Can also be None if there is only one
             possible choice of that feature given the query
             restrictions or if user is unsure
-            cond (str) - (used only the last time the function is
-            called) saves WHERE clause to be used outside the function
-    """
-    add_cond, param_tup = '', ()
-    prev = [tup for tup in prev if tup[1]]
-    if prev:
-        cond_tup, param_tup = zip(*prev)
-        for cond in cond_tup:
-            add_cond += f' AND {cond} = ?'
-    uniq_query = f'SELECT {col} FROM vehicles {WHERE_CMD} {add_cond}'
-    uniq_results = c.execute(uniq_query, base_param + param_tup).fetchall()
-    uniq_results = {str(tup[0]) for tup in uniq_results}
+    """
+    pos = VARIANT_COLS.index(col)
+    uniq_results = {str(variant[pos])
+                    for variant in matching_variants(variants, prev)}
     uniq = len(uniq_results) == 1
     ans = q.select(f"Which matches your car's {col_desc}?\n   ",
                          choices=sorted(uniq_results) + ['Not Sure'],
-                         style=Style(S_CONFIG),
+                         style=prompt_style(),
                          qmark='\n⯁ ').skip_if(uniq).ask()
     if ans == 'Not Sure':
         ans = None
-    return ans, add_cond
+    return ans
+
+
+def matching_variants(variants, answers):
+    """
+    Keeps the variants matching every answer given to unique_helper.
+
+    Parameters:
+        variants (lst): [id, trany, cylinders, drive] lists
+        answers (lst): (col, unique_helper result) tuples, results of
+            None match anything
+
+    Returns:
+        lst: matching variants, in the order they were given
+    """
+    answers = [(VARIANT_COLS.index(col), ans) for col, ans in answers if ans]
+    return [variant for variant in variants
+            if all(str(variant[pos]) == ans for pos, ans in answers)]
+
+
+def first_id(variants):
+    """
+    The id get_id settles on among the variants left: the lowest one.
+
+    Parameters:
+        variants (lst): [id, trany, cylinders, drive] lists
+
+    Returns:
+        int: identifier of the car
+    """
+    return min(variant[0] for variant in variants)
+
+
+def find_id(choices, car):
+    """
+    Non-interactive get_id: the first variant of a car's make, model
+    and year matching the trany, cylinders and drive given, if any.
+
+    Parameters:
+        choices (dict): output of load_choices
+        car (dict): make, model and year, and optionally trany,
+            cylinders and drive
+
+    Returns:
+        int: identifier of the car
+
+    Raises:
+        ValueError: if no car in the database matches
+    """
+    m_y = f'{car["model"]} {int(car["year"])}'
+    variants = choices['variants'].get(car['make'], {}).get(m_y)
+    if not variants:
+        raise ValueError(f'no {car["make"]} {m_y} in the database')
+    answers = [(col, car.get(col) or None) for col in VARIANT_COLS[1:]]
+    if answers[1][1] is not None: # stored as REAL
+        answers[1] = ('cylinders', str(float(answers[1][1])))
+    matches = matching_variants(variants, answers)
+    if not matches:
+        raise ValueError(f'no {car["make"]} {m_y} with '
+                         + ', '.join(f'{col} {ans}' for col, ans in answers
+                                     if ans))
+    return first_id(matches)
+
+
+def to_json(value):
+    """
+    json.dumps default for the NumPy scalars pandas hands back.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
 
 
 def get_miles():
@@ -213,7 +890,7 @@ def get_miles():
     """
     use_miles = q.text('Estimation for weekly miles driven?\n   ',
                        validate=lambda text: txt_validator(text),
-                       style=Style(S_CONFIG), qmark='\n⯁ ').ask()
+                       style=prompt_style(), qmark='\n⯁ ').ask()
     return float(use_miles)
 
 
@@ -265,7 +942,6 @@ def get_emissions(conn, id_, use_miles):
     gpm, agpm = c.execute(co2_query, (id_,)).fetchone()
     c.close()
     if not (gpm or agpm):
-        print('\nElectric Vehicle')
         return 0.0, 0.0
     if not agpm:
         return WEEKS_IN_YEAR * gpm * use_miles, gpm
@@ -326,6 +1002,7 @@ def rank_pref():
                'Passenger capacity', 'Luggage Capacity', 'Stop Ranking']
     DICT_MAP = {'Make': 'make', 'Year': 'year', 'Transmission': 'trany',
                 'Vehicle Class': 'VClass', 'Fuel Type': 'fuelType',
+                'Passenger capacity': 'passenger_volume',
                 'Luggage Capacity': 'luggage_volume'}
     q.print('We will now ask you to rank which attributes you like most '
             'about your current vehicle.\nThese choices will be taken into '
@@ -338,7 +1015,7 @@ def rank_pref():
     rank_order = []
     while len(CHOICES) > 2:
         pref = q.select('Choose preference: ', choices=CHOICES,
-                        style=Style(S_CONFIG), qmark='\n' + str(i)).ask()
+                        style=prompt_style(), qmark='\n' + str(i)).ask()
         if pref == 'Stop Ranking':
             break
         CHOICES.remove(pref)
@@ -350,12 +1027,14 @@ def rank_pref():
     return list((pd.Series(rank_order, dtype = 'object')).map(DICT_MAP))
 
 
-def recommend_cars(conn, id_, use_miles, rank_order, gpm):
+def recommend_cars(conn, id_, use_miles, rank_order, gpm, candidates=None):
     """
     Determines and returns a list of cars to recommend that have less than
       average CO2 emissions with the number of miles inputted by the user.
       It filters for cars that are similar to the user's current car
-      in terms of the attributes they choose 
+      in terms of the attributes they choose, and if more than CAR_LIMIT
+      are left keeps the ones saving the most on fuel over five years,
+      so only those go on to the price lookups
 
     Parameters:
         conn (obj): connection to sqlite database we will be querying
@@ -367,6 +1046,8 @@ def recommend_cars(conn, id_, use_miles, rank_order, gpm):
           in their new car
         gpm (float): grams of CO2 emitted per mile by the current car of the
           user
+        candidates (tup): output of candidate_cars for this car and
+          milage if already read, e.g. by Prefetch
     
     Returns:
         pandas.DataFrame: dataframe with cars to recommend
@@ -374,241 +1055,238 @@ def recommend_cars(conn, id_, use_miles, rank_order, gpm):
     if gpm == 0:
         return "Your carbon emission is 0 - no recommendations were found!"
 
-    conn.create_function("co2_emission", 3, co2_emission)
     c = conn.cursor()
+    df, car_dict = candidates or candidate_cars(c, id_, use_miles, gpm)
+    # positions of the cars kept, only those rows are taken out of df
+    rows = np.flatnonzero(filter_prefs(rank_order, pref_masks(c, id_, df),
+                                       len(df)))
+    cols = [col for col in df.columns if col != "trany_family"]
+    del car_dict["trany_family"]
+
+    #dropping the original car, keeping the best, adding it again
+    if len(rows) > CAR_LIMIT:
+        ids = df["id"].to_numpy()
+        rows = rows[ids[rows] != id_]
+        costs = get_fuel_prices(conn, np.append(ids[rows], id_), use_miles)
+        savings = (costs[-1] - costs[:-1]) * WEEKS_IN_YEAR * 5
+        df = plain_frame(df, rows[top_k(savings, CAR_LIMIT)], cols)
+        df = pd.concat([df, pd.DataFrame([car_dict])], ignore_index=True)
+    else:
+        df = plain_frame(df, rows, cols)
+    c.close()
 
-    current_co2 = (gpm * use_miles)
+    return df
 
-    s1 = (f'SELECT id, make, model, pv2, pv4, hpv, lv2, lv4, hlv, fuelType, '
-          f'VClass, co2_emission(vehicles.co2TailpipeGpm, '
-          f'vehicles.co2TailpipeAGpm, {str(use_miles)}) '
-          f'AS co2_emission, year, trany FROM vehicles WHERE co2_emission <= '
-          f'? AND co2_emission < ?')
-    
-    alt_s = ('SELECT id, make, model, pv2, pv4, hpv, lv2, lv4, hlv, '
-             'fuelType, VClass, year, trany FROM vehicles') #to be potentially used later
-            
-    params = [AVG_EMISSION / WEEKS_IN_YEAR, current_co2]
-    a = c.execute(s1, params)
 
-    df = pd.DataFrame(a.fetchall(),
-                      columns=["id", "make","model", "pv2", "pv4", "hpv",
-                               "lv2", "lv4", "hlv", "fuelType", "VClass",
-                               "co2_emission", "year", "trany"])
+def candidate_cars(c, id_, use_miles, gpm):
+    """
+    Reads the cars emitting less than the average and less than the
+    user's car, and the user's car itself, for recommend_cars.
+
+    Parameters:
+        c (obj): cursor to sqlite database we will be querying
+        id_ (int): unique identifier for user's current car
+        use_miles (float): estimation for user's weekly milage
+        gpm (float): grams of CO2 emitted per mile by the user's car
+
+    Returns:
+        (pandas.DataFrame, dict): the candidates in id order followed
+          by the user's car as the LAST row, and the user's car's row
+    """
+    # co2_emission <= AVG_EMISSION / WEEKS_IN_YEAR and co2_emission <
+    # gpm * use_miles, rewritten as a comparison of the stored gpm.
+    # Most cars pass it, so reading the table in id order is faster
+    # than looking them up through an index on gpm
+    s1 = ('SELECT id, make, model, pv2, pv4, hpv, lv2, lv4, hlv, fuelType, '
+          'VClass, gpm * ? AS co2_emission, year, trany, pv, lv, '
+          'trany_family FROM vehicles WHERE gpm <= ? AND gpm < ? ORDER BY id')
+    if use_miles > 0:
+        params = [use_miles, AVG_EMISSION / WEEKS_IN_YEAR / use_miles, gpm]
+    else: # nothing emits less than the user's 0 grams
+        params = [use_miles, -1, -1]
+    cols = ["id", "make", "model", "pv2", "pv4", "hpv", "lv2", "lv4", "hlv",
+            "fuelType", "VClass", "co2_emission", "year", "trany", "pv", "lv",
+            "trany_family"]
+    categories = load_categories(c.connection)
+    df = vehicle_frame(c.execute(s1, params).fetchall(), cols, categories)
 
     s2 = ('SELECT id, make, model, pv2, pv4, hpv, lv2, lv4, hlv, fuelType, '
-          'VClass, year, trany FROM vehicles WHERE id = ?')
+          'VClass, year, trany, pv, lv, trany_family FROM vehicles '
+          'WHERE id = ?')
+    car_cols = [col for col in cols if col != "co2_emission"]
+    car = c.execute(s2, [str(id_)]).fetchall()
+    car_dict = dict(zip(car_cols, car[0]))
 
-    old_car = c.execute(s2, [str(id_)])
-    (car_id, car_make, car_model, car_pv2, car_pv4, car_hpv, car_lv2, car_lv4,
-     car_hlv, car_fuelType, car_VClass, year, trany) = old_car.fetchall()[0]
+    #important for the price function for this to be the LAST row
+    return (pd.concat([df, vehicle_frame(car, car_cols, categories)],
+                      ignore_index=True), car_dict)
 
-    car_lv = max(car_lv4, car_hlv, car_lv2) #taking the max since some will have 0 as entries
-    car_pv = max(car_pv2, car_pv4, car_hpv)
 
-    match_dict = {"make":car_make, "VClass":car_VClass,
-                  "fuelType":car_fuelType, "year": year,
-                  "luggage_volume": car_lv, "passenger_volume": car_pv,
-                  "trany": trany}
+def pref_masks(c, id_, df):
+    """
+    The rows of a candidate_cars frame matching the user's car in each
+    attribute of rank_pref, as boolean arrays computed the first time
+    they are asked for. Volumes match within 5%, years within 5 years
+    and transmissions by their first word; a volume the user's car has
+    no value for gives None, meaning it can't be filtered on.
 
-    car_dict = {"id":car_id, "make":car_make, "model": car_model,
-                "pv2": car_pv2, "pv4":car_pv4,"hpv":car_hpv, "lv2":car_lv2,
-                "lv4":car_lv4, "hlv":car_hlv, "fuelType":car_fuelType,
-                "VClass":car_VClass, "year":year, "trany": trany}
+    Parameters:
+        c (obj): cursor to sqlite database we will be querying
+        id_ (int): unique identifier for user's current car
+        df (pandas.DataFrame): candidate_cars frame, user's car last
 
-    df = df.append(car_dict, ignore_index=True) #important for the price function for this to be the LAST row
-    
-    for of_interest in rank_order:
-        if of_interest  in ["make", "VClass", "fuelType"]:
-            new_df = df[df[of_interest] == match_dict[of_interest]]
-        elif of_interest == "year":
-            new_df = df[(df[of_interest] >= match_dict[of_interest] - 5)
-                         & (df[of_interest] <= match_dict[of_interest] + 5)]
-        elif of_interest == "trany":
-            m = df["trany"].str.split(" ", expand=True).iloc[:, 0]
-            new_d = pd.concat([df, m], axis=1)
-            new_df = new_d[new_d.iloc[:, -1]
-                           == match_dict[of_interest].split()[0]]
-            new_df = new_df.drop(new_df.columns[-1], axis=1)
-        else:
-            if of_interest == "luggage_volume": #choosing the max for comparison to ignore entries of 0
-                if car_lv == 0:
-                    car_lv = get_volume(c, alt_s, id_, "lv")
-                if car_lv == 0:
-                    continue
-                df = process_df(df, "lv")
-                new_df = df[(df[["lv4", "hlv", "lv2"]].max(axis=1)
-                             >= car_lv * 0.95)
-                            & (df[["lv4", "hlv", "lv2"]].max(axis=1)
-                               <= car_lv * 1.05)]
-            else:
-                if car_pv == 0:
-                    car_pv = get_volume(c, alt_s, id_, "pv")
-                if car_pv == 0:
-                    continue
-                df = process_df(df, "pv")
-                new_df = df[(df[["pv4", "hpv", "pv2"]].max(axis=1)
-                             >= car_pv * 0.95)
-                            & (df[["pv4", "hpv", "pv2"]].max(axis=1)
-                               <= car_pv * 1.05)]
-        if len(new_df) <= MIN_LIMIT:  # discard the new filtering if the resulting number of cars is too small
-            continue
-        df = new_df
-        if len(df) <= CAR_LIMIT:  # break the loop if we have a small enough number of cars
-            break
-    
-    if len(df) > 20:  #dropping the original car, sampling, adding it again
-        df = df.drop(index=df[df["id"] == id_].index)
-        df = df.sample(n=20, random_state=1)
-        df = df.append(car_dict, ignore_index=True)
-    c.close()
+    Returns:
+        MaskCache: boolean mask (or None) of each attribute
+    """
+    car = df.iloc[-1]
+    #taking the max since some will have 0 as entries
+    car_v = {type_: max(car[col] for col in cols)
+             for type_, cols in VOLUME_COLS.items()}
+
+    def mask_for(of_interest):
+        if of_interest in ["make", "VClass", "fuelType"]:
+            return (df[of_interest] == car[of_interest]).to_numpy()
+        if of_interest == "year":
+            return ((df["year"] >= car["year"] - 5)
+                    & (df["year"] <= car["year"] + 5)).to_numpy()
+        if of_interest == "trany":
+            return (df["trany_family"] == car["trany_family"]).to_numpy()
+        # lv and pv hold volumes already filled in by build_db
+        type_ = "lv" if of_interest == "luggage_volume" else "pv"
+        if car_v[type_] == 0:
+            car_v[type_] = get_volume(c, id_, type_)
+        if car_v[type_] == 0:
+            return None
+        v = df[type_].to_numpy()
+        return (v >= car_v[type_] * 0.95) & (v <= car_v[type_] * 1.05)
+
+    return MaskCache(mask_for)
+
+
+class MaskCache(dict):
+    """
+    Dictionary computing the value of a missing key with the given
+    function and keeping it, so that each preference mask is only
+    built once however many rank orders are tried.
+    """
+    def __init__(self, mask_for):
+        super().__init__()
+        self.mask_for = mask_for
 
-    return df
+    def __missing__(self, key):
+        self[key] = self.mask_for(key)
+        return self[key]
 
 
-def co2_emission(co2_1, co2_2, miles):
+def filter_prefs(rank_order, masks, n):
     """
-    Calculates co2 emissions with the given number of miles
-      based on an average value, to be used in the sqlite database.
-    
+    Applies the preferences in rank_order one after the other: each
+    one narrows the cars down unless it would leave MIN_LIMIT or fewer
+    of them, and once CAR_LIMIT or fewer are left the rest are not
+    looked at.
+
     Parameters:
-        co2_1 (float): emitted CO2 in grams/mile for 
-          for the fuel type 1. If the car uses only 1 type
-          of fuel, this is the only CO2 emission value
-        co2_2 (float): emitted CO2 in grams/mile for 
-          for the fuel type 1
-        miles (float): estimation for user's weekly milage, 
-          inputted by the user
-    
+        rank_order (lst): ordered list of attributes the user
+          wants to keep from their current car
+        masks (dict): boolean mask, or None to skip it, of each attribute
+        n (int): number of cars
+
     Returns:
-        float: grams of CO2 emitted with the number of miles
-          user inputted
+        np.array: boolean mask of the cars kept
     """
-    if co2_2 != 0:
-        co2 = (co2_1 + co2_2)/2
-    else:
-        co2 = co2_1
-    return co2 * miles
+    keep = np.ones(n, dtype=bool)
+    for of_interest in rank_order:
+        mask = masks[of_interest]
+        if mask is None:
+            continue
+        new_keep = keep & mask
+        # discard the new filtering if the resulting number of cars is
+        # too small
+        if np.count_nonzero(new_keep) <= MIN_LIMIT:
+            continue
+        keep = new_keep
+        # break the loop if we have a small enough number of cars
+        if np.count_nonzero(keep) <= CAR_LIMIT:
+            break
+    return keep
 
 
-def get_volume(c, string, id_, type_):
+def top_k(scores, k):
     """
-    Get luggage or passenger volume of the input car if it is missing.
+    Positions of the k highest scores, highest first. Ties are broken
+    by position, and nan scores come last.
 
     Parameters:
-        cursor (obj): cursor for database we will be querying
-        string (str): query statement to excute
-        id_ (int): unique identifier for user's current car
+        scores (np.array): score of each car
+        k (int): number of cars to keep
 
     Returns:
-        float: volume in cubic feet
+        np.array: positions into scores
     """
-    if type_ == "lv":
-        lst = ["lv2", "lv4", "hlv"]
+    scores = np.nan_to_num(scores, nan=-np.inf)
+    if len(scores) > k: # only sort what ties with or beats the k-th score
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        best = np.flatnonzero(scores >= kth)
     else:
-        lst = ["pv2", "pv4", "hpv"]
+        best = np.arange(len(scores))
+    return best[np.lexsort((best, -scores[best]))][:k]
 
-    b = c.execute(string)
-    new_df = pd.DataFrame(b.fetchall(),
-                          columns = ["id", "make", "model", "pv2", "pv4",
-                                     "hpv", "lv2", "lv4", "hlv", "fuelType",
-                                     "VClass", "year", "trany"])
-    row = new_df[new_df["id"] == id_]
-    new_df = process_df(new_df, type_, row)
-    new_row = new_df[new_df["id"] == id_]
-    car_v = new_row[lst].max(axis=1).item()
 
-    return car_v
-
-
-def process_df(df, type_, df2=False):
+def get_volume(c, id_, type_):
     """
-    Given a df, volume type, and a second df, fill rows with no volume
-    info with info from cars of the same model.
+    Get luggage or passenger volume of the input car if it is missing.
+    Reads the volume build_db filled in from cars of the same model,
+    only falling back to looking at those cars for rows added without
+    it.
 
     Parameters:
-        df (pd df): dataframe to use to get volume information of
-            other cars.
-        type_ (str): volume type to fill in. either "pv" for passenger
-            volume or "lv" for luggage volume. 
-        df2 (df): a second dataframe that contains rows of cars whose
-            volume values need to be filled in. Defaults no False, in
-            which case df is used for this parameter.
-    
-    Returns:
-        df: pd dataframe with rows with missing volume information
-            have been filled in based on similar cars (when possible).
-    """
-    if isinstance(df2, bool): # means a second df has not been entered
-        df2 = df
-    if type_ == "pv":
-        missing_pv = df2[df2[["pv2", "pv4", "hpv"]].max(axis=1) == 0]
-        df = helper_process_df(df, missing_pv, "pv")
-    elif type_ == "lv":
-        missing_lv = df2[df2[["lv2", "lv4", "hlv"]].max(axis=1) == 0]
-        df = helper_process_df(df, missing_lv, "lv")
-    return df
-
+        c (obj): cursor for database we will be querying
+        id_ (int): unique identifier for user's current car
+        type_ (str): "lv" for luggage or "pv" for passenger volume
 
-def helper_process_df(df, df2, type_):
+    Returns:
+        float: volume in cubic feet
     """
-    Helper function for process_df.
+    cols = VOLUME_COLS[type_]
+    query = (f'SELECT {type_}, make, model, year, {", ".join(cols)} '
+             'FROM vehicles WHERE id = ?')
+    car_v, make, model, year, *own = c.execute(query, (id_,)).fetchone()
+    if car_v is not None:
+        return car_v
+    if max(own) > 0:
+        return max(own)
+    return sibling_volume(c, id_, make, model, year, type_)
+
+
+def sibling_volume(c, id_, make, model, year, type_):
+    """
+    Computes a car's missing volume from the cars of the same make and
+    model family made within four years of it, the same way build_db
+    does, fetching only those rows.
 
     Parameters:
-        df (pd df): dataframe to use to get volume information of
-            other cars.
-        df2 (df): a second dataframe that only contains rows with
-            missing volume information of the relevant type.
-        type_ (str): volume type to fill in. either "pv" for
-            passenger volume or "lv" for luggage volume. 
-    
+        c (obj): cursor for database we will be querying
+        id_ (int): unique identifier for the car
+        make (str): make of the car
+        model (str): model of the car
+        year (int): year the car was made
+        type_ (str): "lv" for luggage or "pv" for passenger volume
+
     Returns:
-        df (pd df): pd dataframe with rows with missing volume
-            information have been filled in based on similar
-            cars (when possible).
+        float: volume in cubic feet, 0 if no similar car has one
     """
-    if type_ == "pv":
-        cols = ["pv2", "pv4", "hpv"] # columns of interest
-    else:
-        cols = ["lv2", "lv4", "hlv"]
-
-    df["first_word"] = pd.read_table(io.StringIO(df["model"].to_csv(None,
-        index=None)), sep=" ", usecols=[0]) # separate the model column by word, take the first word
-
-    for _, row in df2.iterrows():
-        id = row["id"]
-        make = row["make"]
-        model = row["model"]
-        model_str = model.split()[0] # first word of model name
-        year = row["year"]
-        
-        alternatives = df[(df["make"] == make)
-                          & (df["first_word"] == model_str)
-                          & (df["year"].between(year - 4, year + 4))
-                          & (df["id"] != id)
-                          & (df[cols].max(axis=1) > 0)] # similar cars whose volume information is not missing
-
-        if len(alternatives) == 0:
-            continue
-
-        for col in cols: # checking for each column within columns of interest
-            series = alternatives[(alternatives[col] > 0)][col].dropna()
-            if not len(series):
-                continue
-            avg = series.mean().item() 
-            ind = df[df["id"] == id].index.values.astype(int)[0] # find index of car of interest
-            df.at[ind, col] = avg
-
-    df = df.drop(["first_word"], axis=1)
-
-    return df
+    query = (f'SELECT {", ".join(sibling_avgs(type_))} FROM vehicles '
+             'WHERE make = ? AND family = ? AND year BETWEEN ? AND ? '
+             'AND id != ?')
+    params = (make, model.split(' ')[0], year - 4, year + 4, id_)
+    return max(c.execute(query, params).fetchone())
 
 
 def get_savings(conn, id_, use_miles, df):
     """
     Given a df from recommend_cars(), and the user's own car's id,
     calculate the fuel costs and savings and add them to the df
-    returned.
+    returned. Fuel costs of every car are looked up together.
 
     Parameters:
         conn (obj): connection to sqlite database we will be querying
@@ -619,10 +1297,11 @@ def get_savings(conn, id_, use_miles, df):
     Returns:
         df: same dataframe with new columns
     """
-    old_weekly_cost = get_fuel_price(id_, conn, use_miles)
+    costs = get_fuel_prices(conn, np.append(df.id.to_numpy(), id_),
+                            use_miles)
+    old_weekly_cost = costs[-1]
     old_yearly_cost = old_weekly_cost * WEEKS_IN_YEAR
-    df.loc[:, "weekly_cost"] = df.id.apply(get_fuel_price,
-                                           args=(conn, use_miles))
+    df.loc[:, "weekly_cost"] = costs[:-1]
     df.loc[:, "yearly_cost"] = df.loc[:, "weekly_cost"] * WEEKS_IN_YEAR
     df.loc[:, "weekly_savings"] = old_weekly_cost - df.loc[:, "weekly_cost"]
     df.loc[:, "yearly_savings"] = old_yearly_cost - df.loc[:, "yearly_cost"]
@@ -643,30 +1322,84 @@ def get_fuel_price(id_, conn, use_miles):
     Returns:
         float:
     """
-    s1 = "SELECT fuelCost08, fuelCostA08 FROM vehicles WHERE id = ?"
+    return get_fuel_prices(conn, [id_], use_miles)[0]
+
+
+def get_fuel_prices(conn, ids, use_miles):
+    """
+    Gives the money spent on fuel for each of the given cars and
+    a given number of miles, reading the fuel costs of all of them
+    with as few queries as sqlite's parameter limit allows (one for up
+    to MAX_PARAMS cars).
+
+    Parameters:
+        conn (obj): connection to sqlite database we will be querying
+        ids (array): unique identifiers of the cars, may repeat
+        use_miles (float): estimation for user's weekly milage, 
+            inputted by the user
+
+    Returns:
+        np.array: fuel cost of each car, in the order of ids
+    """
+    ids = np.asarray(ids)
+    unique = np.unique(ids).tolist()
     c = conn.cursor()
-    r = c.execute(s1, [str(id_)])
-    rv = r.fetchall()
+    rows = []
+    for start in range(0, len(unique), MAX_PARAMS):
+        batch = unique[start:start + MAX_PARAMS]
+        s1 = ('SELECT id, fuelCost08, fuelCostA08 FROM vehicles '
+              f'WHERE id IN ({", ".join("?" * len(batch))})')
+        rows += c.execute(s1, batch).fetchall()
     c.close()
 
-    fuel1_cost, fuel2_cost = rv[0]
-    if fuel2_cost:
-        cost = (fuel1_cost + fuel2_cost) / 2
-    else:
-        cost = fuel1_cost
-    return (cost / YEARLY_MILES) * use_miles
+    found = np.array([row[0] for row in rows])
+    fuel = np.array([row[1:] for row in rows], dtype=float).reshape(-1, 2)
+    fuel1, fuel2 = fuel[:, 0], np.nan_to_num(fuel[:, 1])
+    cost = np.where(fuel2 != 0, (fuel1 + fuel2) / 2, fuel1)
+    order = np.argsort(found)
+    pos = order[np.searchsorted(found, ids, sorter=order)]
+    return (cost[pos] / YEARLY_MILES) * use_miles
 
 
-def get_car_prices(car_df):
+def get_car_prices(car_df, conn=None, base_url=KBB_URL, ttl=PRICE_TTL,
+                   prefetch=None, deadline=None, show=None, crawler=None):
     """
     Crawls prices for the recommended cars and the user's car
     from kbb and adds them as columns to the inputted dataframe.
     Tries different options for model names to find a match and asks
     the user for an estimation if the price for their old car is
-    not found.
+    not found. Rows are crawled concurrently on a bounded thread
+    pool through one Crawler, which limits connections per host and
+    gives up on cars kbb is too slow or failing to answer for.
+    If a connection is given, prices (and pages with no price) are
+    read from and saved to the prices table so that only stale or
+    missing cars go to the network, and the slugs table decides which
+    model names are tried. Each car's result is committed as soon as
+    it is in. Cars a Prefetch already started crawling are waited for
+    instead of fetched again. The user's car is waited
+    for first, then the other prices are filled in as they arrive.
+    With show, the cars are shown with their fuel savings before any
+    price is waited for.
     
     Parameters:
         car_df (pd.DataFrame): dataframe of cars to be recommended
+        conn (obj): connection to sqlite database holding the price
+            cache. Defaults to None, in which case nothing is cached
+        base_url (str): format string for the price page, filled in
+            with make, model and year. Defaults to kbb
+        ttl (float): seconds before a cached entry is fetched again
+        prefetch (Prefetch): background crawl started for this session
+        deadline (float): seconds after which prices still being
+            fetched are given up on and left missing. Defaults to None,
+            waiting for all of them
+        crawler (Crawler): crawler for the requests, defaults to the one
+            shared by the whole program
+        show (function): called with car_df (the user's car still the
+            last row) and the set of rows whose price is still being
+            fetched: first with every row, then once the user's car is
+            priced and after every price found after that. fresh=True
+            is passed too if the user was asked for their car's price
+            in between
     
     Returns:
         car_df (pd.DataFrame): dataframe of cars to be recommended
@@ -674,50 +1407,503 @@ def get_car_prices(car_df):
         old_car_price (float): price of the user's current car
     """
     car_df["price"] = np.nan
-
-    pm = urllib3.PoolManager(
-       cert_reqs='CERT_REQUIRED',
-       ca_certs=certifi.where())
+    end = None if deadline is None else time.monotonic() + deadline
+    crawler = crawler or get_crawler()
     
     old_car_price = None
     car_df = car_df.reset_index()
     car_df.loc[:, "model"] = car_df.loc[:, "model"].str.replace("/", " ")
-
-    for i, row in car_df.iterrows():
-        make, possible_models, year = get_info_for_price(row)
-        if year < 1992 and i != len(car_df) - 1:
-            continue
-        for _, model in enumerate(possible_models):
-            myurl = f"https://www.kbb.com/{make}/{model}/{year}/"
-            html = pm.urlopen(url=myurl, method="GET").data
-            soup = bs4.BeautifulSoup(html, features="html.parser")
-            title = soup.find_all("title")[0].text
-            if (("Find Your Perfect Car" not in title)
-                and ("Kelley Blue Book | Error" not in title)):
-                break
-        if (("Find Your Perfect Car" in title)
-            or ("Kelley Blue Book | Error" in title)
-            or (str(year) not in title)):
-            continue
-        price_text = soup.find_all("script",
-                                   attrs={"data-rh":"true"})[-1].text
-        m =  re.findall('"price":"([0-9]+)"', price_text)[0]
-        if i == len(car_df) - 1:
-            old_car_price = m
-        car_df.loc[i, "price"] = float(m)
-    
-    old_car_price = q.text('No associated price could be found for your car.'
-                           '\n   What do you believe your car is worth?\n   ',
-                           validate=lambda text: txt_validator(text),
-                           style=Style(S_CONFIG + [('qmark', 'fg:#CF5050')]),
-                           qmark='\n❗').skip_if(old_car_price is not None,
-                                                old_car_price).ask()
-    car_df["difference"] = (float(old_car_price)
-                            - car_df.price[car_df.price.notna()])
+    car_df["difference"] = np.nan
+    old_i = len(car_df) - 1
+
+    if conn is not None:
+        create_price_cache(conn)
+        create_slug_table(conn)
+        c = conn.cursor()
+
+    def collect(i, timeout=None):
+        key, future = futures.pop(i)
+        try:
+            prices[i], tried = future.result(timeout)
+        except CrawlError: # not a miss, so nothing to cache
+            prices[i] = None
+            return
+        if future not in prefetched: # the Prefetch counted its own
+            count_slugs("fetches", len(tried))
+        if conn is not None and tried: # nothing to learn if no slug was tried
+            cache_price(c, key, prices[i])
+            record_slugs(c, key[0], key[1], tried)
+            conn.commit()
+        if prices[i] is not None and i != old_i:
+            car_df.loc[i, "price"] = float(prices[i])
+            car_df.loc[i, "difference"] = (float(old_car_price)
+                                           - float(prices[i]))
+
+    prices, futures, prefetched = {}, {}, set()
+    executor = concurrent.futures.ThreadPoolExecutor(PRICE_WORKERS)
+    try:
+        for i, row in car_df.iterrows():
+            make, possible_models, year = get_info_for_price(row)
+            if year < 1992 and i != old_i:
+                continue
+            key = (make, row["model"], year)
+            future = prefetch.claim(key) if prefetch is not None else None
+            if future is not None:
+                futures[i] = key, future
+                prefetched.add(future)
+                continue
+            if conn is not None:
+                hit, prices[i] = get_cached_price(c, key, ttl)
+                if hit:
+                    continue
+                possible_models = order_slugs(c, make, row["model"],
+                                              possible_models)
+            futures[i] = key, executor.submit(fetch_price, crawler,
+                                              base_url, make,
+                                              possible_models, year)
+
+        if show is not None:
+            show(car_df, set(car_df.index))
+        if old_i in futures:
+            try:
+                collect(old_i, remaining(end))
+            except concurrent.futures.TimeoutError:
+                prices[old_i] = None
+        old_car_price = prices.get(old_i)
+        prompted = old_car_price is None
+        if old_car_price is not None:
+            car_df.loc[old_i, "price"] = float(old_car_price)
+        old_car_price = q.text('No associated price could be found for your '
+                               'car.\n   What do you believe your car is '
+                               'worth?\n   ',
+                               validate=lambda text: txt_validator(text),
+                               style=prompt_style('fg:#CF5050'),
+                               qmark='\n❗').skip_if(
+                                   old_car_price is not None,
+                                   old_car_price).ask()
+
+        for i, m in prices.items():
+            if m is not None and i != old_i:
+                car_df.loc[i, "price"] = float(m)
+        car_df["difference"] = (float(old_car_price)
+                                - car_df.price[car_df.price.notna()])
+        if show is not None and prompted: # the question was printed below
+            show(car_df, set(futures), fresh=True)
+        elif show is not None:
+            show(car_df, set(futures))
+        rows = {} # rows of the same car share a prefetched future
+        for i, (_, future) in futures.items():
+            rows.setdefault(future, []).append(i)
+        try:
+            for future in concurrent.futures.as_completed(rows,
+                                                          remaining(end)):
+                for i in rows[future]:
+                    collect(i)
+                if show is not None:
+                    show(car_df, set(futures))
+        except concurrent.futures.TimeoutError:
+            for _, future in futures.values():
+                future.cancel()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if conn is not None:
+            conn.commit()
+            c.close()
     car_df = car_df.drop(car_df.tail(1).index)
     return car_df, old_car_price
 
 
+def remaining(end):
+    """
+    Seconds left until a time.monotonic() deadline.
+
+    Parameters:
+        end (float): the deadline, None for no deadline
+
+    Returns:
+        float: seconds left, at least 0, or None for no deadline
+    """
+    return None if end is None else max(0, end - time.monotonic())
+
+
+def fetch_price(crawler, base_url, make, possible_models, year):
+    """
+    Fetches the price of a single car, trying each possible model
+    name in order until kbb returns a valid page. Safe to run from
+    several threads at once as long as they share the Crawler. All
+    the requests for the car have FETCH_BUDGET seconds between them.
+
+    Parameters:
+        crawler (Crawler): crawler used for the requests
+        base_url (str): format string for the price page
+        make (str): make of the car
+        possible_models (lst): model names to try, in order
+        year (int): year the car was made
+
+    Returns:
+        tup: price (str) - price of the car, None if no valid page
+            was found (one answered 200 OK, with a kbb title)
+            tried (dict) - maps each model name fetched to True if
+            kbb had a page for it
+
+    Raises:
+        CrawlError: if kbb could not be reached in time
+    """
+    tried = {}
+    if not possible_models:
+        return None, tried
+    end = time.monotonic() + crawler.budget
+    for _, model in enumerate(possible_models):
+        myurl = base_url.format(make, model, year)
+        r = crawler.get(myurl, end)
+        start = time.perf_counter()
+        title, price = extract_price_info(r.data)
+        if TRACE is not None:
+            TRACE.parsed(time.perf_counter() - start)
+        tried[model] = (r.status == 200
+                        and title is not None # not a kbb page at all
+                        and ("Find Your Perfect Car" not in title)
+                        and ("Kelley Blue Book | Error" not in title))
+        if tried[model]:
+            break
+    if not tried[model] or (str(year) not in title):
+        return None, tried
+    return price, tried
+
+
+class CrawlError(Exception):
+    """
+    Raised when a kbb page could not be fetched: the request kept
+    timing out or failing, the car's time budget ran out or kbb is
+    being skipped after too many failures.
+    """
+
+
+class Crawler:
+    """
+    Makes the requests to kbb for every thread crawling prices. Each
+    request has connect and read timeouts and is retried a few times,
+    backing off, after a timeout, a connection error or a 429/5xx
+    answer, without going past the time budget of the car it is for.
+    Up to KBB_REDIRECTS redirects are followed within an attempt.
+    After BREAKER_FAILURES failed attempts in a row the circuit opens:
+    for BREAKER_COOLDOWN seconds requests fail straight away instead
+    of waiting on kbb, and the first attempt after that opens it again
+    if it fails too. How often each of these happens is counted in
+    stats.
+    """
+    def __init__(self, timeout=KBB_TIMEOUT, retries=KBB_RETRIES,
+                 backoff=RETRY_BACKOFF, budget=FETCH_BUDGET,
+                 failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.pm = urllib3.PoolManager(
+            maxsize=HOST_LIMIT,
+            block=True,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where())
+        # no retries inside urllib3, get does them, but follow redirects
+        self.redirects = urllib3.Retry(total=None, connect=0, read=0,
+                                       status=0, other=0,
+                                       redirect=KBB_REDIRECTS)
+        self.timeout, self.retries, self.backoff = timeout, retries, backoff
+        self.budget, self.max_failures = budget, failures
+        self.cooldown = cooldown
+        self.failures, self.open_until = 0, 0
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(['requests', 'timeouts', 'errors',
+                                    'retries', 'out_of_budget',
+                                    'breaker_trips', 'breaker_skips'], 0)
+
+    def get(self, url, end=None):
+        """
+        Fetches a page.
+
+        Parameters:
+            url (str): url of the page
+            end (float): time.monotonic() by which to give up, None for
+                no limit other than the timeouts and retries
+
+        Returns:
+            urllib3.HTTPResponse: the answer, its body read, after any
+                redirects
+
+        Raises:
+            CrawlError: if the page could not be fetched
+        """
+        for attempt in range(self.retries + 1):
+            with self.lock:
+                if time.monotonic() < self.open_until:
+                    self.stats['breaker_skips'] += 1
+                    raise CrawlError(f'skipping {url}, too many failures')
+                if remaining(end) == 0:
+                    self.stats['out_of_budget'] += 1
+                    raise CrawlError(f'out of time for {url}')
+                self.stats['requests'] += 1
+                self.stats['retries'] += attempt > 0
+            left = remaining(end)
+            timeout = urllib3.Timeout(
+                connect=min(self.timeout[0], left or self.timeout[0]),
+                read=min(self.timeout[1], left or self.timeout[1]))
+            r, start = None, time.perf_counter()
+            try:
+                r = self.pm.urlopen('GET', url, timeout=timeout,
+                                    retries=self.redirects)
+            except urllib3.exceptions.HTTPError as e:
+                if isinstance(e, urllib3.exceptions.MaxRetryError):
+                    e = e.reason # what ended the attempt
+                if (isinstance(e, urllib3.exceptions.TimeoutError)
+                        and not isinstance(
+                            e, urllib3.exceptions.NewConnectionError)):
+                    self.failed('timeouts')
+                else: # refused, too many redirects etc.
+                    self.failed('errors')
+            else:
+                if r.status != 429 and r.status < 500:
+                    with self.lock:
+                        self.failures = 0
+                    return r
+                self.failed('errors')
+            finally:
+                if TRACE is not None:
+                    TRACE.fetched(time.perf_counter() - start, r)
+            if attempt < self.retries:
+                wait = self.backoff * 2 ** attempt
+                if end is not None and wait >= remaining(end):
+                    with self.lock:
+                        self.stats['out_of_budget'] += 1
+                    raise CrawlError(f'out of time for {url}')
+                time.sleep(wait)
+        raise CrawlError(f'{url} failed {self.retries + 1} times')
+
+    def failed(self, kind):
+        """
+        Counts a failed attempt, opening the circuit if there have been
+        too many in a row.
+
+        Parameters:
+            kind (str): 'timeouts' or 'errors'
+        """
+        with self.lock:
+            self.stats[kind] += 1
+            self.failures += 1
+            now = time.monotonic()
+            if self.failures >= self.max_failures and now >= self.open_until:
+                self.open_until = now + self.cooldown
+                self.stats['breaker_trips'] += 1
+
+
+def get_crawler():
+    """
+    Returns the Crawler shared by the whole program, so that its
+    connections and circuit breaker outlive a single recommendation.
+    """
+    global CRAWLER
+    if CRAWLER is None:
+        CRAWLER = Crawler()
+    return CRAWLER
+
+
+def extract_price_info(html):
+    """
+    Pulls the page title and the price out of a kbb page without
+    parsing the whole document. The title is the first <title> element
+    and the price is the first "price" field in the last
+    <script data-rh="true"> element, which sits near the end of the
+    page, so it is searched for backwards.
+
+    Parameters:
+        html (bytes): raw page returned by kbb
+
+    Returns:
+        tup: title (str) - page title, None if there is none
+            price (str) - price of the car, None if there is none
+    """
+    match = TITLE_RE.search(html)
+    title = None
+    if match:
+        title = html_lib.unescape(match.group(1).decode('utf-8', 'replace'))
+
+    end = len(html)
+    while True:
+        attr = html.rfind(b'data-rh="true"', 0, end)
+        if attr == -1:
+            return title, None
+        end = html.rfind(b'<', 0, attr)
+        if end == -1:
+            return title, None
+        if html[end:end + 7].lower() == b'<script':
+            break
+    start = html.find(b'>', attr) + 1
+    stop = html.find(b'</script', start)
+    match = PRICE_RE.search(html, start, stop if stop != -1 else len(html))
+    return title, (match.group(1).decode() if match else None)
+
+
+def create_price_cache(conn):
+    """
+    Creates the table used to cache kbb prices if it does not exist.
+    A NULL price records a lookup that found no valid page.
+
+    Parameters:
+        conn (obj): connection to sqlite database
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS prices ('
+                 'make TEXT, model TEXT, year INTEGER, price INTEGER, '
+                 'fetched_at REAL, PRIMARY KEY (make, model, year))')
+
+
+def get_cached_price(c, key, ttl):
+    """
+    Looks up a car in the price cache.
+
+    Parameters:
+        c (obj): cursor for database holding the prices table
+        key (tup): make, model, year of the car
+        ttl (float): seconds before an entry is considered stale
+
+    Returns:
+        tup: hit (bool) - True if a fresh entry was found
+            price (str) - cached price, None for a cached miss
+    """
+    query = ('SELECT price FROM prices '
+             'WHERE make = ? AND model = ? AND year = ? AND fetched_at >= ?')
+    row = c.execute(query, key + (time.time() - ttl,)).fetchone()
+    if row is None:
+        return False, None
+    price = row[0]
+    return True, (None if price is None else str(price))
+
+
+def cache_price(c, key, price):
+    """
+    Saves the result of a price lookup, replacing any older entry.
+
+    Parameters:
+        c (obj): cursor for database holding the prices table
+        key (tup): make, model, year of the car
+        price (str): price found, None if the lookup missed
+    """
+    c.execute('INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?)',
+              key + (None if price is None else int(price), time.time()))
+
+
+def create_slug_table(conn):
+    """
+    Creates the table recording which kbb model names (slugs) work
+    for each make and model, and when they were last tried, if it does
+    not exist. Tables from before slugs were timed get the column,
+    their slugs with no page counting as not tried recently.
+
+    Parameters:
+        conn (obj): connection to sqlite database
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS slugs ('
+                 'make TEXT, model TEXT, slug TEXT, ok INTEGER, '
+                 'checked_at REAL, PRIMARY KEY (make, model, slug))')
+    cols = [row[1] for row in conn.execute('PRAGMA table_info(slugs)')]
+    if 'checked_at' not in cols:
+        conn.execute('ALTER TABLE slugs ADD COLUMN checked_at REAL')
+
+
+def order_slugs(c, make, model, possible_models, ttl=SLUG_TTL):
+    """
+    Orders the model names to try for a car using what was learned
+    from earlier lookups. A slug known to work is tried first, slugs
+    not seen before follow in their original order and slugs that had
+    no page in the last ttl seconds are skipped. Older failures are
+    tried again, in their original order.
+
+    Parameters:
+        c (obj): cursor for database holding the slugs table
+        make (str): make of the car
+        model (str): model of the car, as stored in the database
+        possible_models (lst): candidate slugs from get_info_for_price
+        ttl (float): seconds a slug with no page is skipped for
+
+    Returns:
+        lst: slugs to try, in order
+    """
+    query = ('SELECT slug, ok FROM slugs WHERE make = ? AND model = ? '
+             'AND (ok OR checked_at >= ?)')
+    known = dict(c.execute(query, (make, model, time.time() - ttl)).fetchall())
+    good = [slug for slug, ok in known.items() if ok]
+    with SLUG_LOCK:
+        SLUG_STATS["lookups"] += 1
+        SLUG_STATS["hits"] += bool(good)
+    return good + [slug for slug in dict.fromkeys(possible_models)
+                   if slug not in known]
+
+
+def record_slugs(c, make, model, tried):
+    """
+    Saves which slugs worked for a car after it has been crawled. A
+    slug that has worked before stays marked as working, as kbb also
+    serves its error page for a single year or when it is struggling.
+
+    Parameters:
+        c (obj): cursor for database holding the slugs table
+        make (str): make of the car
+        model (str): model of the car, as stored in the database
+        tried (dict): maps slugs fetched to True if they had a page
+    """
+    now = time.time()
+    c.executemany('INSERT INTO slugs VALUES (?, ?, ?, ?, ?) '
+                  'ON CONFLICT (make, model, slug) DO UPDATE SET '
+                  'ok = max(ok, excluded.ok), '
+                  'checked_at = excluded.checked_at',
+                  [(make, model, slug, int(ok), now)
+                   for slug, ok in tried.items()])
+
+
+def import_slugs(conn, path):
+    """
+    Bulk loads known slugs from a csv file with a make, model and slug
+    header and an optional ok column (1 if the slug works, 0 if it
+    does not, defaults to 1). Lets a shop preload mappings so even
+    the first lookup of a car needs a single request.
+
+    Parameters:
+        conn (obj): connection to sqlite database
+        path (str): path to the csv file
+
+    Returns:
+        int: number of mappings imported
+    """
+    create_slug_table(conn)
+    now = time.time()
+    with open(path, newline='') as f:
+        rows = [(row["make"], row["model"].replace("/", " "), row["slug"],
+                 int(row.get("ok") or 1), now) for row in csv.DictReader(f)]
+    conn.executemany('INSERT OR REPLACE INTO slugs VALUES (?, ?, ?, ?, ?)',
+                     rows)
+    conn.commit()
+    return len(rows)
+
+
+def count_slugs(key, n=1):
+    """
+    Adds n to one of the SLUG_STATS counters, from any thread.
+    """
+    with SLUG_LOCK:
+        SLUG_STATS[key] += n
+
+
+def slug_report():
+    """
+    Summarizes how useful the slug table has been so far this session.
+    Saved with a session's Trace.
+
+    Returns:
+        dict: number of cars looked up, share of them that had a known
+            slug and average number of pages fetched per car
+    """
+    with SLUG_LOCK:
+        lookups, hits, fetches = (SLUG_STATS[key] for key in
+                                  ("lookups", "hits", "fetches"))
+    return {"lookups": lookups,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "fetches_per_car": fetches / lookups if lookups else 0.0}
+
+
 def get_info_for_price(data_str):
     """
     Extracts the needed information (make, model, year)
@@ -769,7 +1955,450 @@ def calculate_savings(car_df, old_car_price):
     return car_df
 
 
-def go():
+class Prefetch:
+    """
+    Work for a session started in the background as soon as the
+    user's car and milage are known, while they are still answering
+    rank_pref: reading the candidate cars recommend_cars filters, then
+    crawling the prices of the user's car and of the PREFETCH_LIMIT
+    candidates saving the most on fuel, the likeliest to be
+    recommended. recommend_cars and get_car_prices pick up this work
+    (waiting for it if needed), keep cancels the fetches of the cars
+    that were not recommended and close whatever is left. The fetches
+    run on HOST_LIMIT threads, as many as the Crawler has connections,
+    so the ones waiting for a connection can still be cancelled.
+    Prices found for cars that end up not being recommended are still
+    cached, so the next session does not crawl them again.
+    """
+    def __init__(self, conn, id_, use_miles, gpm, base_url=KBB_URL,
+                 ttl=PRICE_TTL, crawler=None):
+        """
+        Starts the prefetch.
+
+        Parameters:
+            conn (obj): connection to the session's sqlite database,
+                which the background thread opens again for itself
+            id_ (int): unique identifier for user's current car
+            use_miles (float): estimation for user's weekly milage
+            gpm (float): grams of CO2 emitted per mile by the user's car
+            base_url (str): format string for the price page
+            ttl (float): seconds before a cached price is fetched again
+            crawler (Crawler): crawler for the requests, defaults to the
+                one shared by the whole program
+        """
+        create_price_cache(conn)
+        create_slug_table(conn)
+        conn.commit()
+        self.path = conn.execute('PRAGMA database_list').fetchone()[2]
+        self.lock = threading.Lock()
+        self.futures, self.claimed = {}, set()
+        self.wanted, self.own_key = None, None # None: every car is wanted
+        self.closed, self.conn = False, None
+        self.crawler = crawler or get_crawler()
+        self.executor = concurrent.futures.ThreadPoolExecutor(HOST_LIMIT)
+        self.read = self.executor.submit(self.run, id_, use_miles, gpm,
+                                         base_url, ttl)
+
+    def run(self, id_, use_miles, gpm, base_url, ttl):
+        """
+        Reads the candidates and submits the price fetches, on a
+        thread of the executor.
+
+        Returns:
+            tup: output of candidate_cars
+        """
+        with self.lock:
+            self.conn = connect(self.path)
+        try:
+            c = self.conn.cursor()
+            df, car_dict = candidate_cars(c, id_, use_miles, gpm)
+            likely = df.iloc[:-1]
+            if len(likely) > PREFETCH_LIMIT:
+                costs = get_fuel_prices(self.conn, df.id.to_numpy(),
+                                        use_miles)
+                savings = (costs[-1] - costs[:-1]) * WEEKS_IN_YEAR * 5
+                likely = likely.iloc[top_k(savings, PREFETCH_LIMIT)]
+            # the user's car first, its price is always needed
+            for i, (_, row) in enumerate(pd.concat([df.iloc[-1:], likely])
+                                         .iterrows()):
+                row["model"] = row["model"].replace("/", " ")
+                make, possible_models, year = get_info_for_price(row)
+                if year < 1992 and i != 0:
+                    continue
+                key = (make, row["model"], year)
+                if i == 0:
+                    self.own_key = key
+                if get_cached_price(c, key, ttl)[0]:
+                    continue
+                possible_models = order_slugs(c, make, row["model"],
+                                              possible_models)
+                with self.lock:
+                    if self.closed:
+                        break
+                    if key in self.futures or key in self.claimed:
+                        continue
+                    self.futures[key] = self.executor.submit(
+                        self.fetch, key, base_url, possible_models)
+            c.close()
+            return df, car_dict
+        finally:
+            with self.lock:
+                self.conn.close()
+                self.conn = None
+
+    def fetch(self, key, base_url, possible_models):
+        """
+        fetch_price for a car, on a thread of the executor. Skipped if
+        the car is no longer wanted by the time a thread is free. If the
+        car has not been claimed by the time its price is in, it is
+        cached here, as get_car_prices won't.
+
+        Parameters:
+            key (tup): make, model, year of the car
+            base_url (str): format string for the price page
+            possible_models (lst): model names to try, in order
+
+        Returns:
+            tup: output of fetch_price, no price and no slugs tried if
+                skipped
+        """
+        with self.lock:
+            if key not in self.claimed and (
+                    self.closed
+                    or (self.wanted is not None and key not in self.wanted)):
+                return None, {}
+        price, tried = fetch_price(self.crawler, base_url, key[0],
+                                   possible_models, key[2])
+        count_slugs("fetches", len(tried))
+        with self.lock:
+            claimed = key in self.claimed
+        if tried and not claimed:
+            conn = connect(self.path)
+            try:
+                with conn:
+                    cache_price(conn.cursor(), key, price)
+                    record_slugs(conn.cursor(), key[0], key[1], tried)
+            except sqlite3.OperationalError: # locked for too long, not cached
+                pass
+            finally:
+                conn.close()
+        return price, tried
+
+    def candidates(self):
+        """
+        Waits for the candidate cars to be read.
+
+        Returns:
+            tup: output of candidate_cars, None if the read failed
+        """
+        try:
+            return self.read.result()
+        except (sqlite3.Error, concurrent.futures.CancelledError):
+            return None
+
+    def claim(self, key):
+        """
+        Takes over the price fetch of a car, if one was started, and
+        keeps the prefetch from starting one later otherwise.
+
+        Parameters:
+            key (tup): make, model, year of the car
+
+        Returns:
+            Future: result of fetch_price, None if not prefetched
+        """
+        with self.lock:
+            self.claimed.add(key)
+            return self.futures.get(key)
+
+    def keep(self, rec_df):
+        """
+        Cancels the fetches of the cars recommend_cars did not pick, so
+        that they do not hold kbb connections ahead of the ones that
+        are needed. The user's car is kept. Fetches already under way
+        finish in the background and are cached.
+
+        Parameters:
+            rec_df (pd.DataFrame): output of recommend_cars
+        """
+        wanted = {(row["make"], row["model"].replace("/", " "),
+                   int(row["year"])) for _, row in rec_df.iterrows()}
+        with self.lock:
+            self.wanted = wanted | {self.own_key}
+            for key, future in self.futures.items():
+                if key not in self.wanted and key not in self.claimed:
+                    future.cancel()
+
+    def close(self):
+        """
+        Cancels the fetches that were not claimed and have not started,
+        and the candidate read if it is still running. Fetches already
+        under way finish in the background and are cached.
+        """
+        with self.lock:
+            self.closed = True
+            for key, future in self.futures.items():
+                if key not in self.claimed:
+                    future.cancel()
+            if self.conn is not None:
+                self.conn.interrupt()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def results_table(full_df, pending=()):
+    """
+    Formats the output of calculate_savings for printing, best five
+    year savings first. While some prices are still being fetched the
+    rows are left in place and those prices show as "...".
+
+    Parameters:
+        full_df (pd.DataFrame): dataframe of cars to be recommended
+        pending (set): rows whose price is still being fetched
+
+    Returns:
+        str: the table
+    """
+    col = ['make', 'model', 'year', 'co2_emission', 'weekly_savings',
+           'yearly_savings', 'price', 'difference', 'five_year_savings']
+    final_df = full_df[col]
+    if pending:
+        final_df = final_df.copy()
+        for name in ['price', 'difference', 'five_year_savings']:
+            final_df[name] = ['...' if i in pending else f'{x:.2f}'
+                              for i, x in final_df[name].items()]
+    else:
+        final_df = final_df.sort_values(['five_year_savings', 'co2_emission'],
+                                        ascending=[False, True])
+    return final_df.to_string(index=False, max_colwidth=20,
+                              float_format=lambda x: f'{x:.2f}')
+
+
+class LiveTable:
+    """
+    Shows the recommendations while their prices are coming in: the
+    table is printed as soon as the fuel savings are known and, on a
+    terminal, redrawn in place every time a price arrives.
+    """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.lines = 0
+
+    def show(self, car_df, pending, fresh=False):
+        """
+        Callback for get_car_prices.
+
+        Parameters:
+            car_df (pd.DataFrame): cars to be recommended so far, the
+                user's car as the last row
+            pending (set): rows whose price is still being fetched
+            fresh (bool): something was printed below the last table,
+                so it is not drawn over
+        """
+        if fresh and self.out.isatty():
+            self.lines = 0
+        if self.lines and not self.out.isatty():
+            return
+        full_df = calculate_savings(car_df.drop(car_df.tail(1).index), None)
+        self.draw(results_table(full_df, pending))
+
+    def draw(self, text):
+        """
+        Prints text, over the last table drawn on a terminal.
+        """
+        if self.lines and self.out.isatty():
+            self.out.write(f'\x1b[{self.lines}F\x1b[J')
+        elif self.lines:
+            self.out.write('\n')
+        self.out.write(text + '\n')
+        self.out.flush()
+        self.lines = text.count('\n') + 1
+
+
+class Trace:
+    """
+    Opt-in instrumentation of a session, kept in TRACE: the wall time
+    of each stage of go() (those waiting on the user included), every
+    statement run on the sqlite connections opened with connect and
+    the kbb requests of get_car_prices. Statements are counted with
+    their values taken out, so the same query for different cars adds
+    up. Their time is taken every TRACE_STEPS VM steps by a progress
+    handler, so statements shorter than that count no time.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.stages = []
+        self.sql = {}
+        self.http = dict.fromkeys(['fetches', 'bytes', 'fetch_seconds',
+                                   'parses', 'parse_seconds'], 0)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the with block as a stage called name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages.append({'name': name,
+                                    'start': start - self.origin,
+                                    'seconds': time.perf_counter() - start})
+
+    def watch(self, conn):
+        """
+        Counts and times the statements run on conn from now on.
+
+        Parameters:
+            conn (obj): sqlite connection
+        """
+        running = [None, 0.0] # stats of the statement on conn, last timing
+
+        def statement(sql):
+            key = normalize_sql(sql)
+            with self.lock:
+                stats = self.sql.setdefault(key, {'count': 0, 'seconds': 0.0,
+                                                  'steps': 0})
+                stats['count'] += 1
+            running[:] = [stats, time.perf_counter()]
+
+        def progress():
+            now = time.perf_counter()
+            if running[0] is not None:
+                with self.lock:
+                    running[0]['seconds'] += now - running[1]
+                    running[0]['steps'] += TRACE_STEPS
+            running[1] = now
+            return 0 # keep going
+
+        conn.set_trace_callback(statement)
+        conn.set_progress_handler(progress, TRACE_STEPS)
+
+    def fetched(self, seconds, r):
+        """
+        Counts a request to kbb, r being its answer or None if it failed.
+        """
+        with self.lock:
+            self.http['fetches'] += 1
+            self.http['bytes'] += len(r.data) if r is not None else 0
+            self.http['fetch_seconds'] += seconds
+
+    def parsed(self, seconds):
+        """
+        Counts a kbb page read by extract_price_info.
+        """
+        with self.lock:
+            self.http['parses'] += 1
+            self.http['parse_seconds'] += seconds
+
+    def save(self, path=None):
+        """
+        Writes the trace as JSON, with the crawler's stats and the
+        slug_report.
+
+        Parameters:
+            path (str): file to write, TRACE_FILE by default
+
+        Returns:
+            str: the file written
+        """
+        path = path or TRACE_FILE.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)))
+        sql = [{'statement': key, **stats} for key, stats in
+               sorted(self.sql.items(), key=lambda item: -item[1]['seconds'])]
+        with open(path, 'w') as f:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                time.localtime(self.started)),
+                       'argv': sys.argv[1:],
+                       'seconds': time.perf_counter() - self.origin,
+                       'stages': self.stages, 'sql': sql, 'http': self.http,
+                       'crawler': CRAWLER.stats if CRAWLER else {},
+                       'slugs': slug_report()},
+                      f, indent=1)
+        return path
+
+
+def normalize_sql(sql):
+    """
+    Takes the values out of a statement as sqlite expands it for the
+    trace callback, so runs of the same statement look the same.
+
+    Parameters:
+        sql (str): statement
+
+    Returns:
+        str: statement with ? in place of its values
+    """
+    sql = re.sub(r"[xX]?'(?:[^']|'')*'|(?<![\w.])\d+(?:\.\d+)?(?:e[+-]?\d+)?"
+                 r"(?!\w)", '?', sql)
+    sql = re.sub(r'\?(?:, \?)+', '?, ...', sql)
+    return ' '.join(sql.split())
+
+
+def trace_summary(trace, top=10):
+    """
+    Formats a saved trace as tables: time per stage, the statements
+    that took longest and the kbb requests.
+
+    Parameters:
+        trace (dict): trace loaded from a Trace.save file
+        top (int): number of statements to show
+
+    Returns:
+        str: the tables
+    """
+    lines = [f'Session of {trace["started"]}, {trace["seconds"]:.2f} s',
+             f'{"stage":24}{"s":>9}{"%":>6}']
+    for st in trace['stages']:
+        lines.append(f'{st["name"]:24}{st["seconds"]:9.3f}'
+                     f'{st["seconds"] / trace["seconds"] * 100:6.1f}')
+    sql = trace['sql']
+    lines += ['', f'{len(sql)} statements run '
+              f'{sum(st["count"] for st in sql)} times, '
+              f'{sum(st["seconds"] for st in sql):.3f} s',
+              f'{"count":>7}{"ms":>10}{"steps":>10}  statement']
+    for st in sql[:top]:
+        lines.append(f'{st["count"]:7}{st["seconds"] * 1000:10.1f}'
+                     f'{st["steps"]:10}  {st["statement"][:60]}')
+    http = trace['http']
+    lines += ['', f'kbb: {http["fetches"]} requests, '
+              f'{http["bytes"] / 1024:.0f} KiB taking '
+              f'{http["fetch_seconds"]:.2f} s, {http["parses"]} pages read '
+              f'in {http["parse_seconds"] * 1000:.1f} ms']
+    if trace['crawler']:
+        lines.append('      ' + ', '.join(f'{key} {n}' for key, n
+                                          in trace['crawler'].items()))
+    if trace.get('slugs'): # traces from before slug_report was saved lack it
+        slugs = trace['slugs']
+        lines.append(f'slugs: {slugs["lookups"]} cars looked up, '
+                     f'{slugs["hit_rate"] * 100:.0f}% with a known slug, '
+                     f'{slugs["fetches_per_car"]:.2f} pages fetched per car')
+    return '\n'.join(lines)
+
+
+def connect(database, **kwargs):
+    """
+    sqlite3.connect, with the connection watched by the session's Trace
+    if there is one.
+    """
+    conn = sqlite3.connect(database, **kwargs)
+    if TRACE is not None:
+        TRACE.watch(conn)
+    return conn
+
+
+def stage(name):
+    """
+    Times a stage of go() in the session's Trace if there is one.
+    """
+    if TRACE is None:
+        return contextlib.nullcontext()
+    return TRACE.stage(name)
+
+
+def go(similar=False, stream=False, trace=False):
     """
     Main program, takes users input (their current
     car and daily miles estimation) to compare their
@@ -777,31 +2406,61 @@ def go():
     other drivers. Program will then make recommendations
     of necessary milage reduction and potential new car
     purchases.
+
+    Parameters:
+        similar (bool): recommend the most similar cars, ranked, instead
+          of filtering by preference and sampling
+        stream (bool): show the recommendations right away and fill in
+          prices as they arrive, giving up on them after PRICE_DEADLINE
+        trace (bool): time the session's stages, sqlite statements and
+          kbb requests and save them to a TRACE_FILE
     """
+    global TRACE
+    TRACE = Trace() if trace else None
     # Creates database if none already exists, skips this
     # computationally expensive processes otherwise.
-    try:
-        conn = sqlite3.connect('file:cscc.db?mode=rw', uri=True)
-    except sqlite3.OperationalError:
-        print('Local Database not found.\n'
-              'Creating database...')
-        conn = sqlite3.connect('cscc.db')
-        build_db(conn)
+    with stage('open_db'):
+        try:
+            conn = connect('file:cscc.db?mode=rw', uri=True)
+        except sqlite3.OperationalError:
+            print('Local Database not found.\n'
+                  'Creating database...')
+            conn = connect('cscc.db')
+            build_db(conn)
+        else:
+            migrate_db(conn)
 
-    id_ = get_id(conn)
-    use_miles = get_miles()
+    with stage('get_id'):
+        id_ = get_id(conn)
+    with stage('get_miles'):
+        use_miles = get_miles()
 
-    emissions, gpm = get_emissions(conn, id_, use_miles)
+    with stage('get_emissions'):
+        emissions, gpm = get_emissions(conn, id_, use_miles)
+    if gpm == 0:
+        print('\nElectric Vehicle')
+    # the similar cars come from the catalog, not the prefetched candidates
+    prefetch = None if similar else Prefetch(conn, id_, use_miles, gpm)
     reduce_str = get_cut_recommendation(emissions, gpm)
     q.print(f'\nYearly CO2 emission: {emissions} grams.',
             style=S_CONFIG[1][1])
     q.print(reduce_str, style=S_CONFIG[1][1])
     input('Press any key to continue...\n')
 
-    rank_order = rank_pref()
-    rec_df = recommend_cars(conn, id_, use_miles, rank_order, gpm)
+    with stage('rank_pref'):
+        rank_order = rank_pref()
+    with stage('recommend'):
+        if similar:
+            from catalog import VehicleCatalog
+            rec_df = VehicleCatalog(conn).similar(id_, use_miles, rank_order,
+                                                  gpm)
+        else:
+            rec_df = recommend_cars(conn, id_, use_miles, rank_order, gpm,
+                                    prefetch.candidates())
+            if not isinstance(rec_df, str):
+                prefetch.keep(rec_df)
     if isinstance(rec_df, str):
-        final_df = rec_df
+        print(rec_df)
     else:
         q.print('\nCalculating recommendations...', style=S_CONFIG[1][1])
         if emissions < AVG_EMISSION:
@@ -811,18 +2470,39 @@ def go():
             q.print('Here are some cars that would help you decrease your '
                     'carbon emission to the average:',
                     style=S_CONFIG[1][1])
-        df_with_savings = get_savings(conn, id_, use_miles, rec_df)
-        df_with_prices, old_car_price = get_car_prices(df_with_savings)
-        full_df = calculate_savings(df_with_prices, old_car_price)
-    col = ['make', 'model', 'year', 'co2_emission', 'weekly_savings',
-           'yearly_savings', 'price', 'difference', 'five_year_savings']
-    final_df = full_df[col]
-    final_df = final_df.sort_values(['five_year_savings', 'co2_emission'],
-                                    ascending=[False, True])
-    print(final_df.to_string(index=False, max_colwidth=20,
-                             float_format=lambda x: f'{x:.2f}'))
+        with stage('get_savings'):
+            df_with_savings = get_savings(conn, id_, use_miles, rec_df)
+        live = LiveTable()
+        with stage('get_car_prices'):
+            df_with_prices, old_car_price = get_car_prices(
+                df_with_savings, conn, prefetch=prefetch,
+                deadline=PRICE_DEADLINE if stream else None,
+                show=live.show if stream else None)
+        with stage('results'):
+            full_df = calculate_savings(df_with_prices, old_car_price)
+            live.draw(results_table(full_df))
+    if prefetch is not None:
+        prefetch.close()
     conn.close()
+    if TRACE is not None:
+        print(f'Trace saved to {TRACE.save()}')
 
 
 if __name__ == "__main__":
-    go()
\ No newline at end of file
+    if sys.argv[1:] == ['refresh']:
+        # daily dataset refresh, safe to run while sessions are open
+        with sqlite3.connect('cscc.db') as conn:
+            print(refresh_db(conn) or 'Local Database is up to date.')
+    elif sys.argv[1:2] == ['slugs']:
+        # known kbb slugs, e.g. `python3 cscc.py slugs slugs.csv`
+        with sqlite3.connect('cscc.db') as conn:
+            for path in sys.argv[2:]:
+                print(f'Imported {import_slugs(conn, path)} slugs from {path}')
+    elif sys.argv[1:2] == ['summary']:
+        # tables of saved traces, e.g. `python3 cscc.py summary *.json`
+        for path in sys.argv[2:]:
+            with open(path) as f:
+                print(trace_summary(json.load(f)) + '\n')
+    else:
+        go(similar='similar' in sys.argv[1:], stream='stream' in sys.argv[1:],
+           trace='trace' in sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,225 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Long running local HTTP/JSON service answering cscc.py's questions for
+# other tools, over a pool of read only database connections.
+# Run from inside this directory with `python3 server.py [port]`.
+
+import sys
+import json
+import math
+import queue
+import sqlite3
+import contextlib
+import http.server
+import urllib.parse
+
+import cscc
+from catalog import VehicleCatalog
+
+
+PORT = 8122
+POOL_SIZE = 8 #read only connections shared by the request threads
+
+
+def enable_wal(db):
+    """
+    Switches the database to write-ahead logging, which is persistent,
+    so that refresh_db writing does not block the service's readers
+    and the readers do not block it. Left as is if it can't be written.
+
+    Parameters:
+        db (str): path of cscc.db
+    """
+    try:
+        conn = sqlite3.connect(f'file:{db}?mode=rw', uri=True)
+    except sqlite3.OperationalError: # missing or read only
+        return
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError: # locked by a writer
+        pass
+    conn.close()
+
+
+class ConnectionPool:
+    """
+    Fixed set of read only connections to the database, each used by
+    one request thread at a time.
+    """
+    def __init__(self, db, size=POOL_SIZE):
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(sqlite3.connect(f'file:{db}?mode=ro', uri=True,
+                                          check_same_thread=False))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows an idle connection for the duration of a with block,
+        waiting for one if they are all in use.
+        """
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+def car_args(params):
+    """
+    Reads the id and weekly miles of a request.
+
+    Parameters:
+        params (dict): query string values
+
+    Returns:
+        tup: id and miles
+    """
+    id_, miles = int(params['id']), float(params['miles'])
+    if not 0 <= miles < math.inf:
+        raise ValueError('miles must be a non-negative number')
+    return id_, miles
+
+
+def car_emissions(conn, id_, miles):
+    """
+    get_emissions, for an id that may not be in the database.
+    """
+    if not conn.execute('SELECT 1 FROM vehicles WHERE id = ?',
+                        (id_,)).fetchone():
+        raise ValueError(f'no car with id {id_} in the database')
+    return cscc.get_emissions(conn, id_, miles)
+
+
+def get_id(srv, params):
+    """
+    /id?make=&model=&year=, and optionally &trany=&cylinders=&drive=
+    """
+    return {'id': cscc.find_id(srv.choices, params)}
+
+
+def emissions(srv, params):
+    """
+    /emissions?id=&miles=
+    """
+    id_, miles = car_args(params)
+    with srv.pool.connection() as conn:
+        co2, gpm = car_emissions(conn, id_, miles)
+    return {'id': id_, 'emissions': co2, 'gpm': gpm}
+
+
+def cut_recommendation(srv, params):
+    """
+    /cut?id=&miles=
+    """
+    rv = emissions(srv, params)
+    rv['cut_recommendation'] = cscc.get_cut_recommendation(rv['emissions'],
+                                                           rv['gpm'])
+    return rv
+
+
+def recommend(srv, params):
+    """
+    /recommend?id=&miles=&rank_order=make,year, and &similar=1 for
+    go(similar=True)'s recommendations. Cars come with their savings,
+    prices are left to the caller. Answered from the catalog, which
+    gives the same cars as recommend_cars without reading the table.
+    """
+    id_, miles = car_args(params)
+    rank_order = [pref for pref in params.get('rank_order', '').split(',')
+                  if pref]
+    unknown = set(rank_order) - set(cscc.RANK_PREFS)
+    if unknown:
+        raise ValueError(f'unknown preferences {sorted(unknown)}')
+    with srv.pool.connection() as conn:
+        _, gpm = car_emissions(conn, id_, miles)
+    if params.get('similar') == '1':
+        rec_df = srv.catalog.similar(id_, miles, rank_order, gpm)
+    else:
+        rec_df = srv.catalog.recommend(id_, miles, rank_order, gpm)
+    if isinstance(rec_df, str):
+        return {'id': id_, 'cars': [], 'message': rec_df}
+    rec_df = srv.catalog.savings(id_, miles, rec_df).iloc[:-1]
+    return {'id': id_, 'cars': rec_df[cscc.REC_COLS].to_dict('records')}
+
+
+ROUTES = {'/id': get_id, '/emissions': emissions,
+          '/cut': cut_recommendation, '/recommend': recommend}
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers GET requests to the ROUTES with JSON, keeping connections
+    alive between requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # headers and body go out in two writes
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        route = ROUTES.get(url.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if route is None:
+            status, body = 404, {'error': f'no such endpoint {url.path}'}
+        else:
+            try:
+                status, body = 200, route(self.server, params)
+            except KeyError as e:
+                status, body = 400, {'error': f'missing parameter {e}'}
+            except ValueError as e:
+                status, body = 400, {'error': str(e)}
+            except Exception as e: # answer, don't drop the connection
+                status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+        data = json.dumps(body, default=cscc.to_json).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Service(http.server.ThreadingHTTPServer):
+    """
+    The service, one thread per client connection. Choices and the
+    catalog are loaded once at startup, restart it after a refresh to
+    see the new cars.
+
+    Parameters:
+        db (str): path of cscc.db
+        port (int): port to listen on, 0 for any free one
+        pool_size (int): read only connections to the database
+    """
+    daemon_threads = True
+
+    def __init__(self, db='cscc.db', port=PORT, pool_size=POOL_SIZE):
+        enable_wal(db)
+        self.pool = ConnectionPool(db, pool_size)
+        with self.pool.connection() as conn:
+            self.choices = cscc.load_choices(conn)
+            self.catalog = VehicleCatalog(conn)
+        super().__init__(('127.0.0.1', port), ServiceHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if sys.argv[1:] else PORT
+    with Service(port=port) as srv:
+        print(f'Serving on http://127.0.0.1:{srv.server_port}/')
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,57 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Tests of VehicleCatalog against the sqlite recommendation path, on
+# bench.py's synthetic vehicles.
+
+import pandas as pd
+import pytest
+
+import cscc
+import bench
+from catalog import VehicleCatalog
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    conn = bench.synthetic_db(str(tmp_path_factory.mktemp('catalog')), 5000)
+    yield conn, VehicleCatalog(conn)
+    conn.close()
+
+
+def assert_same(df, expected):
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False,
+                                  check_index_type=False)
+
+
+def test_recommend_matches_recommend_cars(db):
+    conn, cat = db
+    for id_, miles, order, gpm in bench.sessions(conn, 30):
+        expected = cscc.recommend_cars(conn, id_, miles, order, gpm)
+        df = cat.recommend(id_, miles, order, gpm)
+        assert_same(df, expected)
+        assert_same(cat.savings(id_, miles, df.copy()),
+                    cscc.get_savings(conn, id_, miles, expected.copy()))
+
+
+def test_similar_savings_match_get_savings(db):
+    conn, cat = db
+    for id_, miles, order, gpm in bench.sessions(conn, 30):
+        df = cat.similar(id_, miles, order, gpm)
+        assert len(df) > 1
+        assert_same(cat.savings(id_, miles, df.copy()),
+                    cscc.get_savings(conn, id_, miles, df.copy()))
+
+
+def test_volumes_are_compared_at_full_precision():
+    # 94.9999999 rounds to 95.0 in float32, inside 5% of 100
+    cols = ['id', 'pv2', 'pv4', 'hpv', 'lv2', 'lv4', 'hlv', 'pv', 'lv']
+    rows = [(1, 0, 0, 0, 0, 0, 0, 94.9999999, 0),
+            (2, 0, 0, 0, 0, 0, 0, 95.5, 0),
+            (3, 100, 0, 0, 10, 0, 0, 100, 10)]
+    df = cscc.vehicle_frame(rows, cols, {})
+    mask = cscc.pref_masks(None, 3, df)['passenger_volume']
+    assert mask.tolist() == [False, True, True]
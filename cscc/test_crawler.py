@@ -0,0 +1,150 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Tests of the Crawler's timeouts, retries, redirects, time budget and
+# circuit breaker against bench.py's local kbb stand-in.
+
+import time
+
+import pytest
+
+import cscc
+import bench
+
+
+@pytest.fixture
+def kbb(request):
+    srv, url = bench.kbb_server(**getattr(request, 'param', {}))
+    yield srv, url.format('toyota', 'camry', 2015)
+    srv.shutdown()
+    srv.server_close()
+
+
+def crawler(**kwargs):
+    options = dict(timeout=(1, 1), retries=2, backoff=0.01, budget=10,
+                   failures=100, cooldown=60)
+    return cscc.Crawler(**{**options, **kwargs})
+
+
+def test_healthy(kbb):
+    srv, url = kbb
+    cr = crawler()
+    assert b'Price, Value' in cr.get(url).data
+    assert cr.stats['requests'] == 1 and srv.hits == 1
+    assert sum(cr.stats.values()) == 1
+
+
+@pytest.mark.parametrize('kbb', [{'delay': 0.5}], indirect=True)
+def test_timeouts_are_retried(kbb):
+    srv, url = kbb
+    cr = crawler(timeout=(0.1, 0.1))
+    with pytest.raises(cscc.CrawlError):
+        cr.get(url)
+    assert cr.stats['timeouts'] == 3
+    assert cr.stats['requests'] == 3 and cr.stats['retries'] == 2
+
+
+@pytest.mark.parametrize('kbb', [{'error_rate': 1.0}], indirect=True)
+def test_server_errors_are_retried(kbb):
+    srv, url = kbb
+    cr = crawler()
+    with pytest.raises(cscc.CrawlError):
+        cr.get(url)
+    assert cr.stats['errors'] == 3 and srv.hits == 3
+    assert cr.stats['retries'] == 2
+
+
+@pytest.mark.parametrize('kbb', [{'error_rate': 1.0, 'delay': 0.3}],
+                         indirect=True)
+def test_budget(kbb):
+    srv, url = kbb
+    cr = crawler(retries=10, backoff=0.05)
+    start = time.monotonic()
+    with pytest.raises(cscc.CrawlError):
+        cr.get(url, start + 0.5)
+    assert time.monotonic() - start < 0.8
+    assert cr.stats['out_of_budget'] == 1
+    assert cr.stats['requests'] == 2 # the second one cut short
+
+
+@pytest.mark.parametrize('kbb', [{'error_rate': 1.0}], indirect=True)
+def test_breaker(kbb):
+    srv, url = kbb
+    cr = crawler(retries=0, failures=3, cooldown=60)
+    for _ in range(3):
+        with pytest.raises(cscc.CrawlError):
+            cr.get(url)
+    assert cr.stats['breaker_trips'] == 1
+    with pytest.raises(cscc.CrawlError, match='too many failures'):
+        cr.get(url)
+    assert cr.stats['breaker_skips'] == 1
+    assert srv.hits == 3 and cr.stats['requests'] == 3
+
+
+@pytest.mark.parametrize('kbb', [{'error_rate': 1.0}], indirect=True)
+def test_skipped_retry_is_not_counted(kbb):
+    srv, url = kbb
+    cr = crawler(retries=2, failures=2)
+    with pytest.raises(cscc.CrawlError, match='too many failures'):
+        cr.get(url)
+    assert cr.stats['requests'] == 2 and cr.stats['retries'] == 1
+    assert cr.stats['breaker_skips'] == 1
+
+
+@pytest.mark.parametrize('kbb', [{'error_rate': 1.0}], indirect=True)
+def test_breaker_closes_after_cooldown(kbb):
+    _, failing = kbb
+    healthy_srv, url = bench.kbb_server()
+    try:
+        cr = crawler(retries=0, failures=1, cooldown=0.2)
+        with pytest.raises(cscc.CrawlError):
+            cr.get(failing)
+        with pytest.raises(cscc.CrawlError, match='too many failures'):
+            cr.get(url.format('toyota', 'camry', 2015))
+        time.sleep(0.25)
+        assert b'Price, Value' in cr.get(
+            url.format('toyota', 'camry', 2015)).data
+        assert cr.failures == 0
+        with pytest.raises(cscc.CrawlError): # a failure trips it again
+            cr.get(failing)
+        assert cr.stats['breaker_trips'] == 2
+    finally:
+        healthy_srv.shutdown()
+        healthy_srv.server_close()
+
+
+def test_fetch_price_budget():
+    srv, url = bench.kbb_server(delay=0.3, error_rate=1.0)
+    try:
+        cr = crawler(retries=10, backoff=0.05, budget=0.5)
+        start = time.monotonic()
+        with pytest.raises(cscc.CrawlError):
+            cscc.fetch_price(cr, url, 'toyota', ['camry', 'camry-le'], 2015)
+        assert time.monotonic() - start < 0.8
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def test_redirects_are_followed():
+    srv, url = bench.kbb_server(redirect=True)
+    try:
+        cr = crawler()
+        price, tried = cscc.fetch_price(cr, url, 'Toyota', ['camry'], 2015)
+        assert price is not None and tried == {'camry': True}
+        assert srv.hits == 2 and cr.stats['requests'] == 1
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def test_error_pages_are_misses(kbb):
+    srv, url = kbb
+    cr = crawler()
+    url = url.replace('/2015/', '/') # no year, a 404 page
+    price, tried = cscc.fetch_price(cr, url, 'toyota', ['camry'], 2015)
+    assert price is None and tried == {'camry': False}
+    assert cr.stats['requests'] == 1 and sum(cr.stats.values()) == 1
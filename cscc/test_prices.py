@@ -0,0 +1,215 @@
+# CSCC Project
+#
+# CMSC 12200
+#
+# Efe Dogruoz, Ebru Ermis, Mey Abdullahoglu, Kevin Ramirez
+#
+# Tests of get_car_prices against bench.py's local kbb stand-in. Run from
+# inside this directory with `python3 -m pytest`.
+
+import sqlite3
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+import pytest
+import urllib3
+
+import cscc
+import bench
+
+
+@pytest.fixture
+def kbb():
+    srv, url = bench.kbb_server()
+    yield srv, url
+    srv.shutdown()
+    srv.server_close()
+
+
+def recommended(seed=1):
+    """
+    A get_savings frame: recommended cars, some sharing a model, one
+    made before 1992 and one with a / in its model, and the user's car
+    last. The index is left as the candidate rows' labels.
+    """
+    cars = [('Toyota', 'Camry', 2015), ('Honda', 'Civic Hybrid', 2011),
+            ('Ford', 'F150 Pickup 2WD', 2008), ('Toyota', 'Camry', 2015),
+            ('Mazda', 'Protege/5', 2003), ('Dodge', 'Colt', 1989),
+            ('Subaru', 'Outback Wagon', 2019), ('Jeep', 'Wrangler', 1995)]
+    df = pd.DataFrame(cars, columns=['make', 'model', 'year'],
+                      index=np.arange(len(cars)) * 7 + seed)
+    df['co2_emission'] = np.linspace(100, 400, len(cars))
+    df['weekly_savings'] = np.linspace(5, -2, len(cars))
+    df['yearly_savings'] = df['weekly_savings'] * cscc.WEEKS_IN_YEAR
+    return df
+
+
+def sequential_prices(car_df, base_url):
+    """
+    get_car_prices before the thread pool: one row at a time, every
+    model name tried in order on a plain PoolManager.
+    """
+    car_df["price"] = np.nan
+    pm = urllib3.PoolManager()
+    old_car_price = None
+    car_df = car_df.reset_index()
+    car_df.loc[:, "model"] = car_df.loc[:, "model"].str.replace("/", " ")
+    for i, row in car_df.iterrows():
+        make, possible_models, year = cscc.get_info_for_price(row)
+        if year < 1992 and i != len(car_df) - 1:
+            continue
+        for model in possible_models:
+            html = pm.urlopen('GET', base_url.format(make, model, year)).data
+            title, price = bench.soup_price_info(html)
+            if (("Find Your Perfect Car" not in title)
+                    and ("Kelley Blue Book | Error" not in title)):
+                break
+        if (("Find Your Perfect Car" in title)
+                or ("Kelley Blue Book | Error" in title)
+                or (str(year) not in title)):
+            continue
+        if i == len(car_df) - 1:
+            old_car_price = price
+        car_df.loc[i, "price"] = float(price)
+    car_df["difference"] = (float(old_car_price)
+                            - car_df.price[car_df.price.notna()])
+    return car_df.drop(car_df.tail(1).index), old_car_price
+
+
+def test_concurrent_matches_sequential(kbb):
+    _, url = kbb
+    expected, old = sequential_prices(recommended(), url)
+    df, old_car_price = cscc.get_car_prices(recommended(), base_url=url,
+                                            crawler=cscc.Crawler())
+    assert old_car_price == old
+    pd.testing.assert_frame_equal(df, expected)
+    assert df['price'].notna().sum() == 6 # all but the 1989 car
+
+
+def test_cached_prices_match(kbb, tmp_path):
+    srv, url = kbb
+    conn = sqlite3.connect(tmp_path / 'cscc.db')
+    expected, old = sequential_prices(recommended(), url)
+    for _ in range(2):
+        hits = srv.hits
+        df, old_car_price = cscc.get_car_prices(recommended(), conn, url,
+                                                crawler=cscc.Crawler())
+        assert old_car_price == old
+        pd.testing.assert_frame_equal(df, expected)
+    assert srv.hits == hits # the second run was answered from the cache
+    conn.close()
+
+
+def test_slugs(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'cscc.db')
+    conn.execute('CREATE TABLE slugs (make TEXT, model TEXT, slug TEXT, '
+                 'ok INTEGER, PRIMARY KEY (make, model, slug))')
+    conn.execute("INSERT INTO slugs VALUES ('Kia', 'Rio 5', 'rio', 0)")
+    cscc.create_slug_table(conn) # a table from before slugs were timed
+    c = conn.cursor()
+    models = ['rio', 'rio-5']
+    assert cscc.order_slugs(c, 'Kia', 'Rio 5', models) == models
+    cscc.record_slugs(c, 'Kia', 'Rio 5', {'rio': False, 'rio-5': True})
+    assert cscc.order_slugs(c, 'Kia', 'Rio 5', models) == ['rio-5']
+    cscc.record_slugs(c, 'Kia', 'Rio 5', {'rio-5': False})
+    assert cscc.order_slugs(c, 'Kia', 'Rio 5', models) == ['rio-5']
+    assert cscc.order_slugs(c, 'Kia', 'Rio 5', models, ttl=0) == [
+        'rio-5', 'rio']
+    conn.close()
+
+
+def session(conn, url, crawler, id_, miles, order, gpm):
+    """
+    The recommendation and price stages of go() for one car.
+
+    Returns:
+        tup: output of get_car_prices and the session's Prefetch
+    """
+    prefetch = cscc.Prefetch(conn, id_, miles, gpm, url, crawler=crawler)
+    rec_df = cscc.recommend_cars(conn, id_, miles, order, gpm,
+                                 prefetch.candidates())
+    prefetch.keep(rec_df)
+    df = cscc.get_savings(conn, id_, miles, rec_df)
+    rv = cscc.get_car_prices(df, conn, url, prefetch=prefetch,
+                             crawler=crawler)
+    prefetch.close()
+    prefetch.executor.shutdown(wait=True) # let unclaimed fetches finish
+    return rv, prefetch
+
+
+def requested(srv, start=0):
+    """
+    (make, slug, year) of every page asked of the stand-in since the
+    start-th.
+    """
+    return {tuple(urllib.parse.unquote(path).strip('/').split('/'))
+            for path in srv.paths[start:]}
+
+
+def pages(keys):
+    """
+    (make, slug, year) of every page fetch_price may ask for the cars.
+    """
+    return {(make, slug, str(year)) for make, model, year in keys
+            for slug in cscc.get_info_for_price(
+                {'make': make, 'model': model, 'year': year})[1]}
+
+
+def test_repeat_sessions_use_the_cache(kbb, tmp_path):
+    srv, url = kbb
+    conn = bench.synthetic_db(str(tmp_path), 3000)
+    crawler = cscc.Crawler()
+    order = ['make', 'VClass'] # leaves most prefetched cars unrecommended
+    for id_, miles, _, gpm in bench.sessions(conn, 3):
+        first, _ = session(conn, url, crawler, id_, miles, order, gpm)
+        start = len(srv.paths)
+        again, prefetch = session(conn, url, crawler, id_, miles, order, gpm)
+        # only prefetches cancelled the first time are fetched again
+        unwanted = set(prefetch.futures) - prefetch.wanted
+        assert requested(srv, start) <= pages(unwanted)
+        assert again[1] == first[1]
+        pd.testing.assert_frame_equal(again[0], first[0])
+    conn.close()
+
+
+def test_rows_are_shown_before_prices(kbb):
+    _, url = kbb
+    shown = []
+
+    def show(car_df, pending):
+        shown.append((car_df['price'].copy(), set(pending)))
+
+    df, _ = cscc.get_car_prices(recommended(), base_url=url,
+                                crawler=cscc.Crawler(), show=show)
+    first_prices, first_pending = shown[0]
+    assert first_pending == set(range(len(df) + 1)) # the user's car too
+    assert first_prices.isna().all()
+    last_prices, last_pending = shown[-1]
+    assert last_pending == set()
+    assert last_prices.iloc[:-1].equals(df['price'])
+
+
+def test_page_without_title():
+    assert cscc.extract_price_info(b'<html><body>Moved</body></html>') == (
+        None, None)
+    assert cscc.extract_price_info(bench.kbb_page(
+        'toyota', 'camry', 2015, 9000))[0] is not None
+
+
+def test_unrecommended_prefetches_are_cancelled(tmp_path):
+    srv, url = bench.kbb_server(delay=0.2)
+    conn = bench.synthetic_db(str(tmp_path), 3000)
+    try:
+        (id_, miles, _, gpm), = bench.sessions(conn, 1)
+        _, prefetch = session(conn, url, cscc.Crawler(), id_, miles,
+                              ['make', 'VClass'], gpm)
+        cancelled = {key for key, future in prefetch.futures.items()
+                     if future.cancelled()}
+        others = pages(prefetch.wanted | (set(prefetch.futures) - cancelled))
+        assert pages(cancelled) - others
+        assert not requested(srv) & (pages(cancelled) - others)
+    finally:
+        conn.close()
+        srv.shutdown()
+        srv.server_close()